@@ -0,0 +1,47 @@
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def send_chat(base_url: str, user_id: str, text: str) -> float:
+    """发送一次 /chat 请求，返回耗时（秒）"""
+    start = time.perf_counter()
+    response = requests.post(f"{base_url}/chat", data={"text": text, "user_id": user_id})
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def run_benchmark(base_url: str, concurrency: int, text: str):
+    """同时发出 concurrency 个 /chat 请求，比较总耗时与单个请求耗时之和
+
+    服务端模型调用不阻塞事件循环时，总耗时应接近最慢的单个请求，
+    而不是所有请求耗时之和。
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [
+            pool.submit(send_chat, base_url, f"bench_{i}", text)
+            for i in range(concurrency)
+        ]
+        latencies = [f.result() for f in futures]
+    wall_time = time.perf_counter() - start
+
+    print(f"并发请求数: {concurrency}")
+    print(f"单个请求耗时: 最短 {min(latencies):.2f}s, 最长 {max(latencies):.2f}s")
+    print(f"单个请求耗时之和: {sum(latencies):.2f}s")
+    print(f"总耗时: {wall_time:.2f}s (最长单个请求的 {wall_time / max(latencies):.2f} 倍)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/chat 并发压测")
+    parser.add_argument("--base-url", default="http://localhost:8001")
+    parser.add_argument("-n", "--concurrency", type=int, default=8)
+    parser.add_argument("--text", default="1+1等于几？")
+    args = parser.parse_args()
+    run_benchmark(args.base_url, args.concurrency, args.text)
+
+
+if __name__ == "__main__":
+    main()
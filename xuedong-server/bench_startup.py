@@ -0,0 +1,65 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+
+def measure_import(module: str, runs: int) -> list:
+    """在新进程中导入服务模块，返回每次耗时（秒）"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], check=True)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def measure_startup(module: str, port: int, timeout: float) -> dict:
+    """启动 uvicorn，记录端口开始响应和 /ready 返回 200 的时间（秒）"""
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"{module}:app", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    result = {"port_open": None, "ready": None}
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                response = requests.get(f"http://127.0.0.1:{port}/ready", timeout=1)
+                if result["port_open"] is None:
+                    result["port_open"] = time.perf_counter() - start
+                if response.status_code == 200:
+                    result["ready"] = time.perf_counter() - start
+                    break
+            except requests.exceptions.ConnectionError:
+                pass
+            time.sleep(0.05)
+    finally:
+        process.terminate()
+        process.wait()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="服务启动耗时测试")
+    parser.add_argument("--module", default="doubao_server")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    timings = measure_import(args.module, args.runs)
+    print(f"模块导入: 中位数 {statistics.median(timings):.2f}s（{args.runs} 次）")
+
+    startup = measure_startup(args.module, args.port, args.timeout)
+    for name, label in (("port_open", "端口可响应"), ("ready", "/ready 就绪")):
+        value = startup[name]
+        print(f"{label}: {value:.2f}s" if value is not None else f"{label}: 超时")
+
+
+if __name__ == "__main__":
+    main()
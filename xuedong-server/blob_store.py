@@ -0,0 +1,112 @@
+import os
+import re
+import base64
+import hashlib
+import tempfile
+from typing import Dict, List, Optional
+
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+DATA_URI_PATTERN = re.compile(r'^data:([^;,]*);base64,(.*)$', re.S)
+
+
+class BlobStore:
+    """按内容寻址的图片存储
+
+    文件以 SHA-256 命名，保存在 root/前两位/后续两位/完整哈希，
+    相同内容（例如多名学生拍的同一张练习卷）只存一份。
+    """
+
+    def __init__(self, root: str = "./blobs"):
+        self.root = root
+
+    def path(self, sha256: str) -> str:
+        if not SHA256_PATTERN.match(sha256):
+            raise ValueError(f"Invalid blob id: {sha256}")
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def put(self, data: bytes) -> str:
+        """保存内容并返回其 SHA-256；已存在时直接返回"""
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = self.path(sha256)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # 先写临时文件再改名，避免并发写入时读到不完整的文件
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return sha256
+
+    def get(self, sha256: str) -> Optional[bytes]:
+        path = self.path(sha256)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.path(sha256))
+
+
+def make_image_ref(sha256: str, mime_type: str) -> Dict:
+    """消息中引用图片的内容项"""
+    return {"type": "image_ref", "image_ref": {"sha256": sha256, "mime_type": mime_type}}
+
+
+def sniff_mime_type(data: bytes) -> str:
+    """根据文件头判断图片类型"""
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8"):
+        return "image/jpeg"
+    if data.startswith(b"GIF8"):
+        return "image/gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    return "application/octet-stream"
+
+
+def inline_image_refs(messages: List[Dict], store: BlobStore) -> List[Dict]:
+    """发送给模型前把图片引用替换为 base64 data URI；找不到的图片替换为文字占位"""
+    result = []
+    for message in messages:
+        content = message.get("content")
+        if not isinstance(content, list):
+            result.append(message)
+            continue
+        items = []
+        for item in content:
+            if item.get("type") != "image_ref":
+                items.append(item)
+                continue
+            ref = item["image_ref"]
+            data = store.get(ref["sha256"])
+            if data is None:
+                items.append({"type": "text", "text": "[图片已丢失]"})
+                continue
+            encoded = base64.b64encode(data).decode("utf-8")
+            items.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:{ref['mime_type']};base64,{encoded}"}
+            })
+        result.append({**message, "content": items})
+    return result
+
+
+def externalize_data_uris(content: List[Dict], store: BlobStore) -> List[Dict]:
+    """把内容中内联的 base64 图片存入 BlobStore 并替换为引用（用于迁移旧消息）"""
+    items = []
+    for item in content:
+        if item.get("type") == "image_url":
+            match = DATA_URI_PATTERN.match(item.get("image_url", {}).get("url", ""))
+            if match:
+                sha256 = store.put(base64.b64decode(match.group(2)))
+                items.append(make_image_ref(sha256, match.group(1) or "image"))
+                continue
+        items.append(item)
+    return items
@@ -0,0 +1,158 @@
+import os
+import json
+import math
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+
+
+def tokenize(text: str) -> List[str]:
+    """分词，与原先 BM25 检索使用的按空格切分保持一致"""
+    return text.split(" ")
+
+
+class IncrementalBM25:
+    """可增量更新的 BM25 倒排索引
+
+    维护词频、文档长度和文档频率，新增文档为 O(文档词数)，
+    查询只遍历查询词的倒排表，不需要每次重建索引。
+    打分公式与 rank_bm25.BM25Okapi 一致（k1=1.5, b=0.75, epsilon=0.25）。
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_lengths: Dict[str, int] = {}
+        self.documents: Dict[str, str] = {}
+        self.metadatas: Dict[str, Dict] = {}
+        self.total_length = 0
+        self._average_idf_cache: Optional[float] = None
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, doc_id: str, text: str, metadata: Optional[Dict] = None):
+        if doc_id in self.doc_lengths:
+            return
+        tokens = tokenize(text)
+        for term, tf in Counter(tokens).items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.doc_lengths[doc_id] = len(tokens)
+        self.documents[doc_id] = text
+        self.metadatas[doc_id] = metadata or {}
+        self.total_length += len(tokens)
+        self._average_idf_cache = None
+
+    def _idf(self, term: str) -> float:
+        n = len(self.postings.get(term, ()))
+        corpus_size = len(self.doc_lengths)
+        idf = math.log(corpus_size - n + 0.5) - math.log(n + 0.5)
+        if idf < 0:
+            idf = self.epsilon * self._average_idf()
+        return idf
+
+    def _average_idf(self) -> float:
+        # 与 BM25Okapi 相同，负 IDF 用平均 IDF 的 epsilon 倍代替；结果缓存到下次新增文档
+        if self._average_idf_cache is None:
+            corpus_size = len(self.doc_lengths)
+            total = sum(
+                math.log(corpus_size - len(docs) + 0.5) - math.log(len(docs) + 0.5)
+                for docs in self.postings.values()
+            )
+            self._average_idf_cache = total / len(self.postings) if self.postings else 0.0
+        return self._average_idf_cache
+
+    def search(self, query: str, k: int = 3) -> List[str]:
+        """返回得分最高的 k 个文档 id"""
+        if not self.doc_lengths:
+            return []
+        avgdl = self.total_length / len(self.doc_lengths)
+        scores: Dict[str, float] = {}
+        for term in tokenize(query):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = self._idf(term)
+            for doc_id, tf in docs.items():
+                norm = 1 - self.b + self.b * self.doc_lengths[doc_id] / avgdl
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+        # 与整表排序的结果保持一致：命中不足 k 条时按写入顺序补齐 0 分文档
+        if len(ranked) < k:
+            for doc_id in self.doc_lengths:
+                if len(ranked) >= k:
+                    break
+                if doc_id not in scores:
+                    ranked.append(doc_id)
+        return ranked
+
+
+class BM25IndexStore:
+    """按会话维护的 BM25 索引
+
+    每个会话的文档以追加日志（JSON Lines）的形式保存在 root/{session_id}.jsonl，
+    重启后首次访问时重放日志重建索引；内存中按最近使用保留 max_sessions 个会话。
+    """
+
+    def __init__(self, root: str = "./bm25_index", max_sessions: int = 256):
+        self.root = root
+        self.max_sessions = max_sessions
+        self._indexes: "OrderedDict[str, IncrementalBM25]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _log_path(self, session_id: str) -> str:
+        return os.path.join(self.root, f"{session_id}.jsonl")
+
+    def _load(self, session_id: str) -> IncrementalBM25:
+        index = IncrementalBM25()
+        path = self._log_path(session_id)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        index.add(entry["id"], entry["document"], entry.get("metadata"))
+        return index
+
+    def get(self, session_id: str) -> IncrementalBM25:
+        with self._lock:
+            index = self._indexes.pop(session_id, None)
+            if index is None:
+                index = self._load(session_id)
+            self._indexes[session_id] = index
+            while len(self._indexes) > self.max_sessions:
+                self._indexes.popitem(last=False)
+            return index
+
+    def add(self, session_id: str, doc_id: str, document: str, metadata: Optional[Dict] = None):
+        """写入一轮对话：先追加到日志，再更新内存索引"""
+        index = self.get(session_id)
+        with self._lock:
+            if doc_id in index.doc_lengths:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            with open(self._log_path(session_id), "a", encoding="utf-8") as f:
+                f.write(json.dumps({"id": doc_id, "document": document, "metadata": metadata},
+                                   ensure_ascii=False) + "\n")
+            index.add(doc_id, document, metadata)
+
+    def bootstrap(self, session_id: str, ids: List[str], documents: List[str], metadatas: List[Dict]):
+        """用已有的对话记录补建索引（升级前创建的会话只有向量库中的数据）"""
+        for doc_id, document, metadata in zip(ids, documents, metadatas):
+            self.add(session_id, doc_id, document, metadata)
+
+    def search(self, session_id: str, query: str, k: int = 3) -> Dict[str, List]:
+        index = self.get(session_id)
+        with self._lock:
+            top_ids = index.search(query, k)
+            return {
+                'ids': top_ids,
+                'documents': [index.documents[i] for i in top_ids],
+                'metadatas': [index.metadatas[i] for i in top_ids]
+            }
+
+    def evict(self, session_id: str):
+        with self._lock:
+            self._indexes.pop(session_id, None)
@@ -0,0 +1,106 @@
+import re
+import json
+from typing import Dict, List, Optional
+
+CJK_PATTERN = re.compile(r'[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]')
+
+# 图片按固定 token 数估算（模型按分辨率计费，这里取常见手机照片的量级）
+IMAGE_TOKENS = 1000
+
+
+def estimate_tokens(content) -> int:
+    """粗略估算 token 数：中文约 1 字 1 token，其余约 4 个字符 1 token"""
+    if isinstance(content, list):
+        total = 0
+        for item in content:
+            if item.get('type') == 'text':
+                total += estimate_tokens(item.get('text', ''))
+            elif item.get('type') in ('image_url', 'image_ref'):
+                total += IMAGE_TOKENS
+        return total
+    if not isinstance(content, str):
+        content = json.dumps(content, ensure_ascii=False)
+    cjk = len(CJK_PATTERN.findall(content))
+    return cjk + (len(content) - cjk + 3) // 4
+
+
+def strip_images(content):
+    """去掉消息中的图片数据，只保留文字并标注曾有图片"""
+    if not isinstance(content, list):
+        return content
+    texts = []
+    for item in content:
+        if item.get('type') == 'text':
+            texts.append(item.get('text', ''))
+        elif item.get('type') in ('image_url', 'image_ref'):
+            texts.append('[图片]')
+    return ' '.join(t for t in texts if t)
+
+
+def group_turns(history: List[Dict]) -> List[List[Dict]]:
+    """把按时间排序的消息分成轮次：每轮以一条用户消息开始，包含其后的助手回复"""
+    turns: List[List[Dict]] = []
+    for message in history:
+        if message['role'] == 'user' or not turns:
+            turns.append([])
+        turns[-1].append({"role": message['role'], "content": message['content']})
+    return turns
+
+
+def format_turns(turns: List[List[Dict]]) -> str:
+    """把若干轮对话格式化为纯文本（用于生成摘要）"""
+    lines = []
+    for turn in turns:
+        for message in turn:
+            speaker = '学生' if message['role'] == 'user' else '老师'
+            lines.append(f"{speaker}：{strip_images(message['content'])}")
+    return '\n'.join(lines)
+
+
+def build_history_messages(history: List[Dict], summary: Optional[str], summary_turns: int,
+                           keep_turns: int, token_budget: int) -> List[Dict]:
+    """按 token 预算组装会话历史
+
+    - 已被滚动摘要覆盖的前 summary_turns 轮只以摘要形式出现；
+    - 最近 keep_turns 轮原样保留（含图片）；
+    - 其余尚未摘要的较早轮次去掉图片后保留；
+    - 超出预算时从最早的轮次开始丢弃，至少保留最近一轮。
+    """
+    turns = group_turns(history)
+    pending = turns[summary_turns:]
+    recent_start = max(len(pending) - keep_turns, 0)
+
+    blocks: List[List[Dict]] = []
+    for i, turn in enumerate(pending):
+        if i < recent_start:
+            turn = [{"role": m['role'], "content": strip_images(m['content'])} for m in turn]
+        blocks.append(turn)
+
+    summary_message = None
+    used = 0
+    if summary:
+        summary_message = {"role": "system", "content": f"此前对话的摘要：\n{summary}"}
+        used += estimate_tokens(summary_message['content'])
+
+    kept: List[List[Dict]] = []
+    for turn in reversed(blocks):
+        cost = sum(estimate_tokens(m['content']) for m in turn)
+        if kept and used + cost > token_budget:
+            break
+        kept.append(turn)
+        used += cost
+    kept.reverse()
+
+    messages = [summary_message] if summary_message else []
+    for turn in kept:
+        messages.extend(turn)
+    return messages
+
+
+def turns_to_summarize(history: List[Dict], summary_turns: int, keep_turns: int, min_batch: int = 2) -> List[List[Dict]]:
+    """返回需要并入滚动摘要的轮次（最近 keep_turns 轮之前、尚未摘要的部分），不足 min_batch 轮时返回空"""
+    turns = group_turns(history)
+    end = len(turns) - keep_turns
+    if end - summary_turns < min_batch:
+        return []
+    return turns[summary_turns:end]
@@ -0,0 +1,101 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+
+# 数据库路径及连接参数，服务端和管理脚本共用
+DEFAULT_DB_PATH = os.environ.get("DB_PATH", "tty.db")
+BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+CACHE_SIZE_KB = int(os.environ.get("SQLITE_CACHE_SIZE_KB", "20000"))
+CACHED_STATEMENTS = int(os.environ.get("SQLITE_CACHED_STATEMENTS", "256"))
+
+
+def configure_connection(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """设置连接参数
+
+    - WAL 模式：读不阻塞写，写不阻塞读；
+    - synchronous=NORMAL：WAL 模式下只在检查点时 fsync，断电最多丢失最近的事务，不会损坏数据库；
+    - busy_timeout：遇到写锁时等待而不是立即报 database is locked；
+    - mmap_size / cache_size：减少读取时的系统调用和重复解析页面。
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+
+def connect(db_path: Optional[str] = None, **kwargs) -> sqlite3.Connection:
+    """打开一个独立连接（管理脚本使用）"""
+    conn = sqlite3.connect(
+        db_path or DEFAULT_DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=CACHED_STATEMENTS,
+        **kwargs
+    )
+    return configure_connection(conn)
+
+
+@contextmanager
+def get_db_connection(db_path: Optional[str] = None):
+    """with 语句中使用的独立连接，退出时关闭"""
+    conn = connect(db_path)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+class PooledConnection(sqlite3.Connection):
+    """连接池中的连接：close() 只回滚未提交的事务，连接留给同一线程复用"""
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def really_close(self):
+        super().close()
+
+
+class ConnectionPool:
+    """按线程复用 SQLite 连接
+
+    sqlite3 连接不能跨线程使用，这里每个线程（事件循环线程、线程池中的工作线程）
+    各持有一个长连接，省去每次请求打开连接、设置参数和重新编译语句的开销。
+    """
+
+    def __init__(self, db_path: Optional[str] = None, row_factory=sqlite3.Row):
+        self.db_path = db_path or DEFAULT_DB_PATH
+        self.row_factory = row_factory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[PooledConnection] = []
+
+    def get(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.db_path, factory=PooledConnection, check_same_thread=False)
+            conn.row_factory = self.row_factory
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def close_all(self):
+        """关闭所有线程的连接（服务退出时调用）"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.really_close()
+            except sqlite3.Error as e:
+                print(f"Error closing database connection: {e}")
+        self._local = threading.local()
+
+    def stats(self):
+        with self._lock:
+            return {"db_path": self.db_path, "connections": len(self._connections)}
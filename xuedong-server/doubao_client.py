@@ -72,6 +72,69 @@ class ChatClient:
             if image_path and "image_file" in files:
                 files["image_file"].close()
 
+    def send_message_stream(self, text: str, on_delta=None) -> dict:
+        """以流式模式发送消息，逐段回调模型输出，返回与 send_message 相同结构的结果
+
+        Args:
+            text (str): 用户输入
+            on_delta (callable): 每收到一段回复时调用，参数为该段文本
+        """
+        url = f"{self.base_url}/chat"
+        data = {"text": text, "stream": "true"}
+        if not self.session_id:
+            data["user_id"] = self.user_id
+        else:
+            data["session_id"] = self.session_id
+
+        result = {"response": "", "follow_up_suggestions": []}
+        with requests.post(url, data=data, stream=True) as response:
+            response.raise_for_status()
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    payload = json.loads(line[len("data:"):].strip())
+                    if event == "session":
+                        result["session_id"] = payload["session_id"]
+                    elif event == "delta":
+                        result["response"] += payload["content"]
+                        if on_delta:
+                            on_delta(payload["content"])
+                    elif event == "follow_ups":
+                        result["follow_up_suggestions"] = payload["follow_up_suggestions"]
+                    elif event == "error":
+                        raise RuntimeError(payload["detail"])
+
+        if not self.session_id and result.get("session_id"):
+            self.session_id = result["session_id"]
+            print(f"新会话已创建，session_id: {self.session_id}")
+
+        self.save_to_history(text, result)
+        return result
+
+    def get_follow_ups(self, follow_up_id: Optional[str] = None, wait: float = 10) -> List[str]:
+        """获取后台生成的后续问题建议，默认长轮询最多 wait 秒
+
+        Args:
+            follow_up_id (Optional[str]): 回答对应的 follow_up_id，不传则取当前会话最新一条
+            wait (float): 最长等待秒数
+        """
+        if follow_up_id:
+            url = f"{self.base_url}/follow_ups/{follow_up_id}"
+        elif self.session_id:
+            url = f"{self.base_url}/chat/{self.session_id}/follow_ups"
+        else:
+            return []
+
+        try:
+            response = requests.get(url, params={"wait": wait})
+            response.raise_for_status()
+            return response.json().get("follow_up_suggestions", [])
+        except requests.exceptions.RequestException as e:
+            print(f"网络错误: {e}")
+            return []
+
     def clear_history(self):
         """清除对话历史"""
         if self.session_id:
@@ -212,10 +275,12 @@ def main():
             response = client.send_message(user_input, image_path, image_url)
             print("\n助手: ", response["response"])
             
-            # 显示后续问题建议
-            if "follow_up_suggestions" in response and response["follow_up_suggestions"]:
+            # 显示后续问题建议（服务端在回答返回后才生成）
+            follow_up_suggestions = response.get("follow_up_suggestions") or \
+                client.get_follow_ups(response.get("follow_up_id"))
+            if follow_up_suggestions:
                 print("\n💡 你可以继续问：")
-                for i, question in enumerate(response["follow_up_suggestions"], 1):
+                for i, question in enumerate(follow_up_suggestions, 1):
                     print(f"{i}. {question}")
             
             print("-" * 50)
@@ -240,9 +305,11 @@ def main():
                     print(result["answer"])
                     
                     # 显示后续练习建议
-                    if "follow_up_suggestions" in result and result["follow_up_suggestions"]:
+                    follow_up_suggestions = result.get("follow_up_suggestions") or \
+                        client.get_follow_ups(result.get("follow_up_id"))
+                    if follow_up_suggestions:
                         print("\n💡 你可以继续问：")
-                        for i, question in enumerate(result["follow_up_suggestions"], 1):
+                        for i, question in enumerate(follow_up_suggestions, 1):
                             print(f"{i}. {question}")
                     
                     print("-" * 50)
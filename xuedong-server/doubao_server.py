@@ -1,23 +1,37 @@
 import os
 import time
-import sqlite3
-from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Body
-from volcenginesdkarkruntime import Ark
-import base64
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Body, BackgroundTasks, Request
+from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from volcenginesdkarkruntime import AsyncArk
 from dotenv import load_dotenv
 from typing import Optional, Dict, List
 from datetime import datetime, timedelta
-import faiss
-from sentence_transformers import SentenceTransformer
-import numpy as np
 import json
 import requests
 import uuid
 from uvicorn import run
-import chromadb
-from chromadb.config import Settings
 import re
-from rank_bm25 import BM25Okapi
+from bm25_index import BM25IndexStore
+from message_search import ensure_message_fts, search_session_turns, search_user_messages
+from lazy_resource import LazyResource
+from database import ConnectionPool
+from message_writer import MessageWriter, current_timestamp
+from history_cache import HistoryCache
+from index_queue import VectorIndexQueue, ensure_index_queue
+from upstream_gateway import (
+    UpstreamGateway, AdaptiveConcurrencyLimiter, CircuitBreaker, Priority, UpstreamUnavailableError
+)
+from model_registry import ModelRegistry, chat_task
+from singleflight import SingleFlight, make_key
+from structured_output import FOLLOW_UP_TAG, FOLLOW_UP_INSTRUCTION, FollowUpStreamParser, split_follow_ups
+from blob_store import BlobStore, make_image_ref, inline_image_refs, sniff_mime_type
+from context_builder import build_history_messages, turns_to_summarize, format_turns
+from maketable import migrate_database, ensure_session_stats
 
 # Load environment variables
 load_dotenv('.env')
@@ -25,129 +39,365 @@ load_dotenv('.env')
 # Initialize FastAPI app
 app = FastAPI()
 
-# Database connection
+# 图片存储（按内容寻址，去重）
+blob_store = BlobStore(os.environ.get("BLOB_STORE_PATH", "./blobs"))
+
+# Database connection（按线程复用，路径由 DB_PATH 配置）
+db_pool = ConnectionPool()
+
 def get_db():
-    conn = sqlite3.connect('tty.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    """获取当前线程的数据库连接；用完调用 close() 只会回滚未提交的事务，不会真正关闭"""
+    return db_pool.get()
+
+# 消息写入队列：多个请求的消息合并到一个事务提交
+# MESSAGE_WRITE_MODE=strict（默认）时 store_message 等到消息提交后才返回，并发请求仍共用一次 fsync；
+# async 不等待提交，响应更快，但队列只在内存中，进程崩溃或被强制结束时会丢失已返回给客户端的消息
+MESSAGE_WRITE_STRICT = os.environ.get("MESSAGE_WRITE_MODE", "strict") != "async"
+message_writer = MessageWriter(
+    db_pool.db_path,
+    max_batch_size=int(os.environ.get("MESSAGE_WRITE_BATCH_SIZE", "256")),
+    max_wait_ms=float(os.environ.get("MESSAGE_WRITE_MAX_WAIT_MS", "10"))
+)
+
+# 解析后的会话历史缓存（按总字节数 LRU 淘汰），store_message 写入时同步追加
+history_cache = HistoryCache(int(os.environ.get("HISTORY_CACHE_MAX_BYTES", str(64 * 1024 * 1024))))
 
 # Initialize Ark client
-client = Ark(
+# 使用异步客户端，模型调用期间不阻塞事件循环
+client = AsyncArk(
     api_key=os.environ.get("ARK_API_KEY"),
     timeout=120,
-    max_retries=2,
+    # 重试由 upstream_gateway 在并发控制下完成，SDK 自带的重试会在限流时放大请求量
+    max_retries=0,
     base_url="https://ark.cn-beijing.volces.com/api/v3"
 )
 
-# Initialize FAISS index
-embedding_dim = 384  
-index = faiss.IndexFlatL2(embedding_dim)
-model = SentenceTransformer('all-MiniLM-L6-v2')
+# 各任务使用的模型接入点、超时和 max_tokens，见 MODEL_CONFIG_PATH（示例：models.example.json）
+models = ModelRegistry.from_file(os.environ.get("MODEL_CONFIG_PATH", "./models.json"))
+
+# 内容相同的并发生成请求（同一知识点出题、同一回答的后续问题）只调用一次模型
+inflight = SingleFlight()
+
+# 所有模型调用经过同一个网关：AIMD 自适应并发上限（ARK_MIN_CONCURRENCY ~ ARK_MAX_CONCURRENCY），
+# 超出上限的请求按优先级排队（对话 > 批改 > 出题 > 后续问题 > 后台任务）
+upstream = UpstreamGateway(
+    client,
+    AdaptiveConcurrencyLimiter(
+        initial_limit=int(os.environ.get("ARK_INITIAL_CONCURRENCY", 8)),
+        min_limit=int(os.environ.get("ARK_MIN_CONCURRENCY", 2)),
+        max_limit=int(os.environ.get("ARK_MAX_CONCURRENCY", 16))
+    ),
+    max_retries=int(os.environ.get("ARK_MAX_RETRIES", 2)),
+    latency_threshold=float(os.environ.get("ARK_LATENCY_THRESHOLD_S", 30)),
+    first_token_threshold=float(os.environ.get("ARK_FIRST_TOKEN_THRESHOLD_S", 5)),
+    # 最近 ARK_BREAKER_WINDOW_S 秒内失败率过高时熔断，ARK_BREAKER_OPEN_S 秒内直接返回 503
+    breaker=CircuitBreaker(
+        failure_rate=float(os.environ.get("ARK_BREAKER_FAILURE_RATE", 0.5)),
+        min_calls=int(os.environ.get("ARK_BREAKER_MIN_CALLS", 10)),
+        window=float(os.environ.get("ARK_BREAKER_WINDOW_S", 30)),
+        open_seconds=float(os.environ.get("ARK_BREAKER_OPEN_S", 15))
+    )
+)
+
+# 对冲请求：可重复执行的调用超过 p95 耗时仍未返回时再发一个相同请求，取先完成的结果
+ARK_HEDGING = os.environ.get("ARK_HEDGING", "1") != "0"
+
+async def create_chat_completion(priority: Priority = Priority.INTERACTIVE, hedge: bool = False, **kwargs):
+    """调用模型（非流式），经过网关排队和并发控制；hedge 只应用于可重复执行的调用"""
+    return await upstream.create(priority, hedge=hedge and ARK_HEDGING, **kwargs)
+
+async def stream_chat_completion(priority: Priority = Priority.INTERACTIVE, **kwargs):
+    """流式调用模型，逐段产出回复文本；整个流持续期间占用一个并发名额"""
+    async for chunk in upstream.stream(priority, **kwargs):
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            yield delta
+
+@app.exception_handler(UpstreamUnavailableError)
+async def upstream_unavailable_handler(request: Request, exc: UpstreamUnavailableError):
+    """熔断期间快速失败，提示客户端稍后重试"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, int(exc.retry_after)))}
+    )
+
+@app.get("/upstream/stats")
+async def upstream_stats_endpoint():
+    """模型调用的并发上限、排队情况和重试统计"""
+    return {**upstream.stats(), "coalescing": inflight.stats()}
+
+@app.get("/models")
+async def models_endpoint():
+    """各任务当前使用的模型接入点和调用参数"""
+    return models.to_dict()
+
+# Initialize embedding model
+# 对话轮次的向量在写入时计算一次，与文档一起存入 ChromaDB
+# 并发的向量计算请求由 EmbeddingService 合并成批次，EMBEDDING_BACKEND 可选 torch/onnx/int8
+# 相同文本的向量按内容哈希缓存（内存 LRU + 磁盘），EMBEDDING_CACHE_PATH 为空时只用内存
+# 模型在启动后由后台任务加载（sentence_transformers/torch 导入很慢），不阻塞端口
+EMBEDDING_MODEL_NAME = 'all-MiniLM-L6-v2'
+
+def create_embedding_service():
+    from embedding_service import EmbeddingService, load_model
+    from embedding_cache import EmbeddingCache
+
+    model = load_model(EMBEDDING_MODEL_NAME, os.environ.get("EMBEDDING_BACKEND", "torch"))
+    embedding_cache = EmbeddingCache(
+        EMBEDDING_MODEL_NAME,
+        model.get_sentence_embedding_dimension(),
+        path=os.environ.get("EMBEDDING_CACHE_PATH", "./embedding_cache") or None,
+        memory_entries=int(os.environ.get("EMBEDDING_CACHE_ENTRIES", 10000))
+    )
+    return EmbeddingService(
+        model,
+        max_batch_size=int(os.environ.get("EMBEDDING_MAX_BATCH", 64)),
+        max_wait_ms=float(os.environ.get("EMBEDDING_MAX_WAIT_MS", 5)),
+        cache=embedding_cache
+    )
+
+embedding_resource = LazyResource("embedding_model", create_embedding_service)
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    """计算文本向量"""
+    return embedding_resource.get().encode(texts)
+
+@app.get("/embedding/stats")
+async def embedding_stats_endpoint():
+    """向量计算服务的吞吐和延迟统计"""
+    if not embedding_resource.loaded:
+        raise HTTPException(status_code=503, detail="Embedding model is not loaded yet")
+    return embedding_resource.get().stats()
+
+@app.get("/storage/stats")
+async def storage_stats_endpoint():
+    """数据库连接和消息写入队列的统计"""
+    return {
+        "database": db_pool.stats(),
+        "message_writer": message_writer.stats(),
+        "history_cache": history_cache.stats()
+    }
+
+# 分页接口每页的默认和最大条数
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def clamp_page_size(limit: Optional[int]) -> Optional[int]:
+    return None if limit is None else min(max(limit, 1), MAX_PAGE_SIZE)
+
+def row_to_message(row) -> Dict:
+    role = "user" if row['sender_type'] == 'user' else "assistant"
+    return {
+        "message_id": row['message_id'],
+        "role": role,
+        "content": json.loads(row['content']) if row['sender_type'] == 'user' else row['content'],
+        "timestamp": row['timestamp']
+    }
 
 def get_message_history(session_id: int) -> List[Dict]:
-    """从数据库获取会话历史记录"""
+    """获取会话历史记录，优先读取缓存（先等待该会话排队中的消息写入）"""
+    message_writer.wait_session(session_id, timeout=5)
+    return history_cache.load(session_id, lambda: load_message_history(session_id))
+
+def load_message_history(session_id: str) -> List[Dict]:
+    """从数据库读取会话历史记录"""
     db = get_db()
     try:
         cursor = db.execute(
             """
-            SELECT sender_type, content, timestamp 
+            SELECT message_id, sender_type, content, timestamp 
             FROM message 
             WHERE session_id = ? 
-            ORDER BY timestamp
+            ORDER BY timestamp, message_id
             """, 
             (session_id,)
         )
-        messages = []
-        for row in cursor:
-            role = "user" if row['sender_type'] == 'user' else "assistant"
-            messages.append({
-                "role": role,
-                "content": json.loads(row['content']) if row['sender_type'] == 'user' else row['content'],
-                "timestamp": row['timestamp']
-            })
-        return messages
+        return [row_to_message(row) for row in cursor]
     finally:
         db.close()
 
-def get_user_sessions(user_id: str) -> List[Dict]:
-    """获取用户的所有会话记录及消息数量"""
+def get_message_page(session_id: str, limit: int, before: Optional[int] = None, after: Optional[int] = None):
+    """按 (timestamp, message_id) 游标分页读取会话消息，走 (session_id, timestamp) 索引
+
+    Args:
+        session_id (str): 会话ID
+        limit (int): 每页条数
+        before (int): 返回该消息之前的消息；before 和 after 都为空时返回最新的一页
+        after (int): 返回该消息之后的消息
+
+    Returns:
+        tuple: (按时间正序的消息列表, 该方向上是否还有更多消息)
+    """
+    message_writer.wait_session(session_id, timeout=5)
+    if after is not None:
+        condition = "AND (timestamp, message_id) > (SELECT timestamp, message_id FROM message WHERE message_id = ?)"
+        order = "ASC"
+        params = (session_id, after, limit + 1)
+    elif before is not None:
+        condition = "AND (timestamp, message_id) < (SELECT timestamp, message_id FROM message WHERE message_id = ?)"
+        order = "DESC"
+        params = (session_id, before, limit + 1)
+    else:
+        condition = ""
+        order = "DESC"
+        params = (session_id, limit + 1)
+
+    db = get_db()
+    try:
+        rows = db.execute(
+            f"""
+            SELECT message_id, sender_type, content, timestamp
+            FROM message
+            WHERE session_id = ? {condition}
+            ORDER BY timestamp {order}, message_id {order}
+            LIMIT ?
+            """,
+            params
+        ).fetchall()
+    finally:
+        db.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if order == "DESC":
+        rows.reverse()
+    return [row_to_message(row) for row in rows], has_more
+
+def get_user_sessions(user_id: str, limit: Optional[int] = None, before: Optional[str] = None) -> List[Dict]:
+    """获取用户的会话记录及消息数量（统计列由 message 表上的触发器维护）
+
+    Args:
+        user_id (str): 用户ID
+        limit (int): 最多返回的条数，为空时返回全部
+        before (str): 游标，返回该会话之后（更早开始）的会话
+    """
+    condition = ""
+    params: list = [user_id]
+    if before is not None:
+        # 以 (start_time, rowid) 为游标，同一时间开始的会话也不会漏掉或重复
+        condition = "AND (start_time, rowid) < (SELECT start_time, rowid FROM session WHERE session_id = ?)"
+        params.append(before)
+    params.append(-1 if limit is None else limit)
+
     db = get_db()
     try:
         cursor = db.execute(
-            """
-            SELECT s.session_id, 
-                   s.start_time,
-                   s.status,
-                   COUNT(m.message_id) as message_count,
-                   (SELECT content 
-                    FROM message 
-                    WHERE session_id = s.session_id 
-                    AND sender_type = 'user' 
-                    ORDER BY timestamp 
-                    LIMIT 1) as first_message
-            FROM session s
-            LEFT JOIN message m ON s.session_id = m.session_id
-            WHERE s.user_id = ?
-            GROUP BY s.session_id
-            ORDER BY s.start_time DESC
+            f"""
+            SELECT session_id, start_time, status, message_count, preview, last_active_at
+            FROM session
+            WHERE user_id = ? {condition}
+            ORDER BY start_time DESC, rowid DESC
+            LIMIT ?
             """,
-            (user_id,)
+            params
         )
-        sessions = []
-        for row in cursor:
-            preview = ""
-            # 处理第一条消息
-            first_message = row['first_message']
-            if first_message:
-                try:
-                    # 尝试解析JSON格式的用户消息
-                    message_content = json.loads(first_message)
-                    # 提取文本内容
-                    preview = next((item['text'] for item in message_content if item['type'] == 'text'), '')
-                except json.JSONDecodeError:
-                    preview = first_message
-
-            sessions.append({
+        return [
+            {
                 "session_id": row['session_id'],
                 "start_time": row['start_time'],
                 "status": row['status'],
-                "message_count": row['message_count'],
-                "preview": preview[:50] + '...' if len(preview) > 50 else preview  # 预览前50个字符
-            })
-        return sessions
+                "message_count": row['message_count'] or 0,
+                "preview": row['preview'] or "",
+                "last_active_at": row['last_active_at']
+            }
+            for row in cursor
+        ]
     finally:
         db.close()
 
 @app.get("/user/{user_id}/sessions")
-async def get_user_sessions_endpoint(user_id: str):
-    """获取用户的所有会话列表"""
+async def get_user_sessions_endpoint(user_id: str, limit: Optional[int] = None, before: Optional[str] = None):
+    """获取用户的会话列表
+
+    不传 limit 时返回全部会话；传入 limit 时按开始时间倒序分页，
+    下一页以上一页最后一个会话的 session_id 作为 before 参数。
+    """
     try:
-        sessions = get_user_sessions(user_id)
+        limit = clamp_page_size(limit)
+        sessions = get_user_sessions(user_id, None if limit is None else limit + 1, before)
+        has_more = limit is not None and len(sessions) > limit
+        if limit is not None:
+            sessions = sessions[:limit]
         print(sessions)
         return {
             "user_id": user_id,
-            "sessions": sessions
+            "sessions": sessions,
+            "has_more": has_more,
+            "next_before": sessions[-1]["session_id"] if has_more else None
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def format_image_refs(content, request: Request):
+    """把消息中的图片引用转换为可直接访问的图片地址"""
+    if not isinstance(content, list):
+        return content
+    items = []
+    for item in content:
+        if item.get("type") == "image_ref":
+            items.append({
+                "type": "image",
+                "url": str(request.url_for("get_blob_endpoint", sha256=item["image_ref"]["sha256"]))
+            })
+        else:
+            items.append(item)
+    return items
+
+@app.get("/blobs/{sha256}")
+async def get_blob_endpoint(sha256: str):
+    """按 SHA-256 获取图片"""
+    try:
+        path = blob_store.path(sha256)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid blob id")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Blob not found")
+    with open(path, "rb") as f:
+        header = f.read(16)
+    return FileResponse(
+        path,
+        media_type=sniff_mime_type(header),
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
 @app.get("/chat/{session_id}/messages")
-async def get_chat_history_endpoint(session_id: str):
-    """获取指定会话的历史消息"""
+async def get_chat_history_endpoint(
+    session_id: str,
+    request: Request,
+    limit: Optional[int] = None,
+    before: Optional[int] = None,
+    after: Optional[int] = None
+):
+    """获取指定会话的历史消息
+
+    不传分页参数时返回全部消息；传入 limit/before/after 时按 message_id 游标分页：
+    只传 limit 返回最新一页，before 取更早的消息，after 取更新的消息。
+    """
     try:
-        messages = get_message_history(session_id)
+        # 读库前会等待该会话尚未提交的消息，放到线程池中执行，不阻塞事件循环
+        if limit is None and before is None and after is None:
+            messages = await run_in_threadpool(get_message_history, session_id)
+            has_more = False
+        else:
+            messages, has_more = await run_in_threadpool(
+                get_message_page, session_id, clamp_page_size(limit) or DEFAULT_PAGE_SIZE, before, after
+            )
         
         # 格式化返回的消息
         formatted_messages = []
         for msg in messages:
             message_data = {
+                "message_id": msg["message_id"],
                 "role": msg["role"],
                 "timestamp": None  # 数据库中的timestamp字段
             }
             
             # 处理用户消息
             if msg["role"] == "user":
-                message_data["content"] = msg["content"]  # 已经是JSON格式
+                message_data["content"] = format_image_refs(msg["content"], request)  # 已经是JSON格式
             else:
                 # AI消息直接使用文本内容
                 message_data["content"] = msg["content"]
@@ -156,7 +406,8 @@ async def get_chat_history_endpoint(session_id: str):
             
         return {
             "session_id": session_id,
-            "messages": formatted_messages
+            "messages": formatted_messages,
+            "has_more": has_more
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -180,6 +431,15 @@ def create_new_session(user_id: str) -> str:
     finally:
         db.close()
 
+def get_session_user_id(session_id: str) -> Optional[str]:
+    """查询会话所属的用户"""
+    db = get_db()
+    try:
+        row = db.execute("SELECT user_id FROM session WHERE session_id = ?", (session_id,)).fetchone()
+        return row['user_id'] if row else None
+    finally:
+        db.close()
+
 def clean_message_content(content: str) -> str:
     """清理消息内容，去除多余空白和特殊字符"""
     if isinstance(content, str):
@@ -189,52 +449,75 @@ def clean_message_content(content: str) -> str:
         content = content.strip()
     return content
 
-def store_message(session_id: str, sender_type: str, content: str):
-    """存储消息到数据库"""
-    db = get_db()
-    try:
-        # 如果是用户消息，需要处理JSON格式
-        if sender_type == 'user':
-            # 确保content是有效的JSON字符串
-            if isinstance(content, str):
-                try:
-                    content_obj = json.loads(content)
-                    # 清理文本内容
-                    if isinstance(content_obj, list):
-                        for item in content_obj:
-                            if item.get('type') == 'text':
-                                item['text'] = clean_message_content(item['text'])
-                    content = json.dumps(content_obj, ensure_ascii=False)
-                except json.JSONDecodeError:
-                    content = json.dumps([{"type": "text", "text": clean_message_content(content)}])
-        else:
-            # AI回复直接清理内容
-            content = clean_message_content(content)
+def store_message(session_id: str, sender_type: str, content: str, wait: Optional[bool] = None,
+                  turn: Optional[int] = None):
+    """存储消息到数据库
 
-        db.execute(
-            """
-            INSERT INTO message (session_id, sender_type, content)
-            VALUES (?, ?, ?)
-            """,
-            (session_id, sender_type, content)
-        )
-        db.commit()
-    finally:
-        db.close()
+    消息进入写入队列，由后台线程合并提交；wait 为 None 时按 MESSAGE_WRITE_MODE 决定是否等待提交完成。
 
-def url_to_base64(image_url: str) -> Optional[str]:
-    """从 URL 下载图片并转换为 Base64 字符串"""
+    Args:
+        turn (int): 消息所属的对话轮号，见 next_turn_number
+
+    Returns:
+        Future: 消息提交后完成，结果为 message_id
+    """
+    # 如果是用户消息，需要处理JSON格式
+    if sender_type == 'user':
+        # 确保content是有效的JSON字符串
+        if isinstance(content, str):
+            try:
+                content_obj = json.loads(content)
+                # 清理文本内容
+                if isinstance(content_obj, list):
+                    for item in content_obj:
+                        if item.get('type') == 'text':
+                            item['text'] = clean_message_content(item['text'])
+                content = json.dumps(content_obj, ensure_ascii=False)
+            except json.JSONDecodeError:
+                content = json.dumps([{"type": "text", "text": clean_message_content(content)}])
+    else:
+        # AI回复直接清理内容
+        content = clean_message_content(content)
+
+    timestamp = current_timestamp()
+    message = {
+        "message_id": None,
+        "role": "user" if sender_type == 'user' else "assistant",
+        "content": json.loads(content) if sender_type == 'user' else content,
+        "timestamp": timestamp
+    }
+    # 先入队再追加到缓存：入队即登记为该会话待提交的写入，之后开始的读取会先等它提交，
+    # 不会把缺少这条消息的历史放入缓存；message_id 在提交后补上
+    future = message_writer.submit(
+        session_id, sender_type, content, timestamp,
+        on_commit=lambda message_id: message.update(message_id=message_id),
+        turn=turn
+    )
+    history_cache.append(session_id, message, len(content))
+
+    def on_done(f):
+        # 写入失败时缓存中的这条消息在数据库中并不存在，丢弃缓存，下次从数据库重新加载
+        if f.exception() is not None:
+            history_cache.invalidate(session_id)
+
+    future.add_done_callback(on_done)
+    if wait is None:
+        wait = MESSAGE_WRITE_STRICT
+    if wait:
+        future.result()
+    return future
+
+def download_image(image_url: str) -> Optional[bytes]:
+    """从 URL 下载图片"""
     try:
         response = requests.get(image_url)
         response.raise_for_status()  # 检查请求是否成功
-        image_content = response.content
-        base64_encoded = base64.b64encode(image_content).decode('utf-8')
-        return base64_encoded
+        return response.content
     except requests.exceptions.RequestException as e:
         print(f"Error fetching image from {image_url}: {e}")
         return None
 
-def generate_follow_up_questions(context: str) -> List[str]:
+async def generate_follow_up_questions(context: str) -> List[str]:
     """根据当前对话内容生成后续问题建议
     
     Args:
@@ -265,38 +548,200 @@ def generate_follow_up_questions(context: str) -> List[str]:
         {"role": "user", "content": f"基于以下回答生成后续问题：\n{context}"}
     ]
     
-    response = client.chat.completions.create(
-        model="ep-20250105222308-5f4lk",
-        messages=messages
-    )
+    async def call():
+        response = await create_chat_completion(
+            priority=Priority.FOLLOW_UP,
+            hedge=True,
+            **models.request_kwargs("follow_ups"),
+            messages=messages
+        )
+        return response.choices[0].message.content
+
+    # 相同回答的并发请求共用一次调用
+    content = await inflight.do(make_key("follow_ups", context), call)
     
     # 处理返回的问题列表
-    questions = response.choices[0].message.content.strip().split('\n')
+    questions = content.strip().split('\n')
     return [q.strip() for q in questions if q.strip()]
 
-def get_session_db(session_id: str):
-    """Get or create a ChromaDB client for the session"""
-    db_path = f"./chroma_dbs/{session_id}.db"
-    # Ensure directory exists
-    os.makedirs("./chroma_dbs", exist_ok=True)
-    
-    client = chromadb.PersistentClient(path=db_path)
-    
-    # Get or create collection for this session
-    collection = client.get_or_create_collection(
-        name="chat_history",
-        metadata={"session_id": session_id}
-    )
-    
-    return collection
+# 后续问题的生成方式：inline 让模型在回答末尾用 <wenti> 标签一并给出（一次调用），
+# separate 在回答后单独调用模型生成；inline 模式下模型未按格式输出时也会退回单独生成
+FOLLOW_UP_MODE = os.environ.get("FOLLOW_UP_MODE", "inline")
+
+# 相同知识点的并发出题请求如何合并：request 按知识点和历史题目合并（历史题目不同时各自调用），
+# knowledge 只按知识点合并（忽略各自的历史题目，合并更多请求），off 不合并
+KNOWLEDGE_COALESCE_SCOPE = os.environ.get("KNOWLEDGE_COALESCE_SCOPE", "request")
+
+# 后续问题长轮询的检查间隔和最长等待时间（秒）
+FOLLOW_UP_POLL_INTERVAL = 0.1
+FOLLOW_UP_MAX_WAIT = 30
+
+class FollowUpCache:
+    """后台生成的后续问题建议缓存
 
-def get_conversation_count(collection) -> int:
-    """Get the current conversation count for the session"""
+    每条回答对应一个 follow_up_id，同时记录每个会话最新一条的 id，
+    超出容量时淘汰最早的记录。
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._latest_by_session: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def create(self, session_id: Optional[str] = None) -> str:
+        """登记一条待生成的记录并返回其 follow_up_id"""
+        follow_up_id = f"fu_{uuid.uuid4().hex}"
+        with self._lock:
+            self._entries[follow_up_id] = {
+                "session_id": session_id,
+                "ready": False,
+                "follow_up_suggestions": [],
+                "error": None,
+                "done": threading.Event()
+            }
+            if session_id:
+                self._latest_by_session[session_id] = follow_up_id
+            while len(self._entries) > self.max_entries:
+                evicted_id, evicted = self._entries.popitem(last=False)
+                if self._latest_by_session.get(evicted["session_id"]) == evicted_id:
+                    del self._latest_by_session[evicted["session_id"]]
+        return follow_up_id
+
+    def set_result(self, follow_up_id: str, suggestions: List[str], error: Optional[str] = None):
+        with self._lock:
+            entry = self._entries.get(follow_up_id)
+            if entry is None:
+                return
+            entry["follow_up_suggestions"] = suggestions
+            entry["error"] = error
+            entry["ready"] = True
+        entry["done"].set()
+
+    def latest_id(self, session_id: str) -> Optional[str]:
+        with self._lock:
+            return self._latest_by_session.get(session_id)
+
+    async def wait(self, follow_up_id: str, timeout: float = 0) -> Optional[Dict]:
+        """长轮询：最多等待 timeout 秒直到结果就绪，返回记录快照；id 不存在时返回 None"""
+        with self._lock:
+            entry = self._entries.get(follow_up_id)
+        if entry is None:
+            return None
+
+        deadline = time.monotonic() + timeout
+        while not entry["done"].is_set() and time.monotonic() < deadline:
+            await asyncio.sleep(FOLLOW_UP_POLL_INTERVAL)
+
+        return {
+            "follow_up_id": follow_up_id,
+            "ready": entry["ready"],
+            "follow_up_suggestions": entry["follow_up_suggestions"],
+            "error": entry["error"]
+        }
+
+follow_up_cache = FollowUpCache(int(os.environ.get("FOLLOW_UP_CACHE_SIZE", 1000)))
+
+async def compute_follow_ups(follow_up_id: str, context: str):
+    """后台任务：生成后续问题并写入缓存"""
     try:
-        results = collection.get()
-        return len(results['ids'])
-    except:
-        return 0
+        suggestions = await generate_follow_up_questions(context)
+        follow_up_cache.set_result(follow_up_id, suggestions)
+    except Exception as e:
+        print(f"Follow-up generation error: {e}")
+        follow_up_cache.set_result(follow_up_id, [], error=str(e))
+
+def schedule_follow_ups(background_tasks: BackgroundTasks, context: str, session_id: Optional[str] = None,
+                        suggestions: Optional[List[str]] = None) -> str:
+    """登记后续问题并返回 follow_up_id
+
+    已随回答一起生成（FOLLOW_UP_MODE=inline）时直接写入缓存；否则在响应返回后单独调用模型生成。
+    """
+    follow_up_id = follow_up_cache.create(session_id)
+    if suggestions:
+        follow_up_cache.set_result(follow_up_id, suggestions)
+    else:
+        background_tasks.add_task(compute_follow_ups, follow_up_id, context)
+    return follow_up_id
+
+@app.get("/follow_ups/{follow_up_id}")
+async def get_follow_ups_endpoint(follow_up_id: str, wait: float = 0):
+    """获取后续问题建议，wait>0 时最多等待 wait 秒（长轮询）"""
+    result = await follow_up_cache.wait(follow_up_id, min(max(wait, 0), FOLLOW_UP_MAX_WAIT))
+    if result is None:
+        raise HTTPException(status_code=404, detail="Follow-up suggestions not found")
+    return result
+
+@app.get("/chat/{session_id}/follow_ups")
+async def get_session_follow_ups_endpoint(session_id: str, wait: float = 0):
+    """获取会话最近一条回答的后续问题建议"""
+    follow_up_id = follow_up_cache.latest_id(session_id)
+    if follow_up_id is None:
+        raise HTTPException(status_code=404, detail="No follow-up suggestions for this session")
+    result = await follow_up_cache.wait(follow_up_id, min(max(wait, 0), FOLLOW_UP_MAX_WAIT))
+    if result is None:
+        raise HTTPException(status_code=404, detail="No follow-up suggestions for this session")
+    result["session_id"] = session_id
+    return result
+
+# 会话向量库：按会话分目录的连接池，或所有会话共用的 collection（见 VECTOR_STORE_MODE）
+def create_vector_store():
+    from vector_store import create_session_store
+    return create_session_store()
+
+session_store_resource = LazyResource("vector_store", create_vector_store)
+
+# 按会话增量维护的 BM25 索引，用于历史对话检索
+bm25_store = BM25IndexStore(
+    root=os.environ.get("BM25_INDEX_PATH", "./bm25_index"),
+    max_sessions=int(os.environ.get("BM25_CACHE_SESSIONS", 256))
+)
+
+def session_db(session_id: str, user_id: Optional[str] = None):
+    """租用会话的 ChromaDB collection（with 语句），租用期间不会被连接池关闭"""
+    return session_store_resource.get().lease(session_id, user_id)
+
+async def sweep_idle_session_dbs(interval: float = 60):
+    """定期关闭空闲的会话向量库，即使没有新请求也能释放句柄"""
+    while True:
+        await asyncio.sleep(interval)
+        if session_store_resource.loaded:
+            await run_in_threadpool(session_store_resource.get().evict_idle)
+
+@app.on_event("startup")
+async def start_session_db_sweeper():
+    asyncio.create_task(sweep_idle_session_dbs())
+
+@app.on_event("shutdown")
+async def close_session_dbs():
+    # 先停止向量索引队列，它会用到下面关闭的向量库和向量模型
+    index_queue.stop()
+    if session_store_resource.loaded:
+        session_store_resource.get().close_all()
+    if embedding_resource.loaded:
+        embedding_resource.get().close()
+    message_writer.close()
+    db_pool.close_all()
+
+def next_turn_number(db, session_id: str, user_id: Optional[str] = None) -> int:
+    """在调用方的事务中把会话的轮数加一并返回新的轮号
+
+    同一会话的并发请求各自得到不同的轮号，不会生成重复的向量库 id。
+    会话表中没有记录时（客户端自带的 session_id）先补建，轮数从消息表中已有的最大轮号开始。
+    """
+    db.execute("UPDATE session SET turn_count = turn_count + 1 WHERE session_id = ?", (session_id,))
+    row = db.execute("SELECT turn_count FROM session WHERE session_id = ?", (session_id,)).fetchone()
+    if row:
+        return row['turn_count']
+    db.execute(
+        """
+        INSERT INTO session (session_id, user_id, start_time, status, turn_count)
+        VALUES (?, ?, datetime('now', 'localtime'), 'active',
+                COALESCE((SELECT MAX(turn) FROM message WHERE session_id = ?), 0) + 1)
+        """,
+        (session_id, user_id or '', session_id)
+    )
+    return db.execute("SELECT turn_count FROM session WHERE session_id = ?", (session_id,)).fetchone()['turn_count']
 
 def contains_temporal_reference(text: str) -> bool:
     """检查文本是否包含时间引用词"""
@@ -306,98 +751,155 @@ def contains_temporal_reference(text: str) -> bool:
     ]
     return any(word in text for word in temporal_words)
 
-def search_previous_context(collection, query: str, k: int = 3):
-    """搜索相关的历史对话"""
+# 启动时补齐数据库新增的列并创建消息全文索引；SQLite 版本过低时退回 BM25 索引
+message_fts_enabled = False
+
+@app.on_event("startup")
+async def init_database_schema():
+    global message_fts_enabled
+    db = get_db()
     try:
-        # 使用模型将查询文本向量化
-        query_vector = model.encode([query]).tolist()  # 将查询文本转换为向量
-        
-        # 获取所有文档和元数据
-        results = collection.get()
-        documents = results['documents']
-        metadatas = results['metadatas']
-        
-        # 使用 BM25 进行检索
-        tokenized_docs = [doc.split(" ") for doc in documents]  # 将文档分词
-        bm25 = BM25Okapi(tokenized_docs)  # 初始化 BM25
-        tokenized_query = query.split(" ")  # 将查询分词
-        bm25_scores = bm25.get_scores(tokenized_query)  # 计算 BM25 分数
-        
-        # 将 BM25 分数与向量检索结果结合
-        combined_scores = [(i, bm25_scores[i]) for i in range(len(documents))]
-        combined_scores.sort(key=lambda x: x[1], reverse=True)  # 按 BM25 分数排序
-        
-        # 选择前 k 个文档
-        top_k_indices = [combined_scores[i][0] for i in range(min(k, len(combined_scores)))]
-        
-        # 返回 BM25 和向量检索的结果
-        return {
-            'documents': [documents[i] for i in top_k_indices],
-            'metadatas': [metadatas[i] for i in top_k_indices]
-        }
-    except Exception as e:
-        print(f"Vector search error: {e}")
-        return None
+        migrate_database(db)
+        ensure_session_stats(db)
+        message_fts_enabled = ensure_message_fts(db)
+        ensure_index_queue(db)
+    finally:
+        db.close()
 
-@app.post("/chat")
-async def chat_endpoint(
-    text: str = Form(...),
-    image_url: Optional[str] = Form(None),
-    image_file: Optional[UploadFile] = File(None),
-    session_id: Optional[str] = Form(None),
-    user_id: Optional[str] = Form(None)
-):
-    # 验证参数
-    if session_id is None and not user_id:
-        raise HTTPException(status_code=400, detail="Must provide user_id for new session")
-        
-    # 如果没有session_id，创建新会话
-    if session_id is None:
-        session_id = create_new_session(user_id)
-    
-    # 准备当前消息
-    current_message = [{"type": "text", "text": text}]
+def warm_up_resources():
+    """后台预热向量库和向量模型，并做一次向量计算让模型完成首次初始化"""
+    session_store_resource.warm_up()
+    embedding_resource.warm_up()
+    if embedding_resource.loaded:
+        embed_texts(["warm up"])
 
-    # 处理图片URL
-    if image_url:
-        base64_image = url_to_base64(image_url)
-        if base64_image:
-            file_extension = image_url.split('.')[-1].lower()
-            mime_type = f"image/{file_extension}" if file_extension in ["png", "jpg", "jpeg", "gif", "webp"] else "image"
-            current_message.append({
-                "type": "image_url",
-                "image_url": {
-                    "url": f"data:{mime_type};base64,{base64_image}"
-                }
-            })
+@app.on_event("startup")
+async def start_warm_up():
+    # 不等待预热完成，端口立即可用；就绪状态见 /ready
+    if os.environ.get("WARMUP_ON_STARTUP", "1") != "0":
+        asyncio.create_task(run_in_threadpool(warm_up_resources))
 
-    # 处理上传的图片文件
-    elif image_file:
-        image_content = await image_file.read()
-        base64_image = base64.b64encode(image_content).decode('utf-8')
-        current_message.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/{image_file.filename.split('.')[-1]};base64,{base64_image}"
-            }
-        })
+@app.get("/ready")
+async def readiness_endpoint():
+    """就绪探针：向量模型和向量库都已加载时返回 200，否则返回 503"""
+    components = {
+        "embedding_model": embedding_resource.status(),
+        "vector_store": session_store_resource.status(),
+        "message_fts": {"ready": message_fts_enabled}
+    }
+    ready = embedding_resource.loaded and session_store_resource.loaded
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"ready": ready, "components": components}
+    )
 
-    # Check for temporal references and search context
-    context_message = ""
-    if session_id and contains_temporal_reference(text):
-        collection = get_session_db(session_id)
-        search_results = search_previous_context(collection, text)
-        
-        if search_results and search_results['documents']:
-            print("\n=== Vector Search Results ===")
-            for doc, meta in zip(search_results['documents'], search_results['metadatas']):
-                print("Matched Document:", doc)
-                print("Metadata:", meta)  # 确保 meta 是字典
-                context_message += f"第{meta['turn']}轮对话：\n{doc}\n"
-            print("=========================\n")  # 输出分隔线
+@app.get("/user/{user_id}/search")
+async def search_user_messages_endpoint(user_id: str, q: str, limit: int = 20):
+    """在用户所有会话中搜索提过的问题"""
+    if not message_fts_enabled:
+        raise HTTPException(status_code=503, detail="Full-text search is not available")
+    results = await run_in_threadpool(search_user_history, user_id, q, min(max(limit, 1), 100))
+    return {
+        "user_id": user_id,
+        "query": q,
+        "results": results
+    }
 
-    # Prepare messages with context
-    messages = [{"role": "system", "content": """
+def search_user_history(user_id: str, query: str, limit: int) -> List[Dict]:
+    db = get_db()
+    try:
+        return search_user_messages(db, user_id, query, limit)
+    finally:
+        db.close()
+
+def ensure_bm25_index(session_id: str, collection):
+    """升级前创建的会话只有向量库中的数据，首次使用时补建 BM25 索引"""
+    if len(bm25_store.get(session_id)) >= collection.count():
+        return
+    results = collection.get()
+    bm25_store.bootstrap(
+        session_id,
+        [f"conv_{meta['turn']}" for meta in results['metadatas']],
+        results['documents'],
+        results['metadatas']
+    )
+
+# 混合检索：向量检索在独立线程中与关键词检索并行，超出时间预算则只用关键词结果
+RETRIEVAL_BUDGET_MS = float(os.environ.get("RETRIEVAL_BUDGET_MS", 300))
+RRF_K = 60
+retrieval_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("RETRIEVAL_WORKERS", 4)),
+    thread_name_prefix="retrieval"
+)
+
+def vector_search(session_id: str, query: str, k: int) -> Dict[str, List]:
+    """按向量相似度检索会话内的历史对话
+
+    在检索线程中自行租用 collection：超出时间预算后请求不再等待，检索仍可能在进行。
+    """
+    query_embeddings = embed_texts([query])
+    with session_db(session_id) as collection:
+        total = collection.count()
+        if total == 0:
+            return {'documents': [], 'metadatas': []}
+        results = collection.query(
+            query_embeddings=query_embeddings,
+            n_results=min(k, total)
+        )
+    return {
+        'documents': results['documents'][0],
+        'metadatas': results['metadatas'][0]
+    }
+
+def keyword_search(session_id: str, query: str, k: int) -> Dict[str, List]:
+    """按关键词（BM25）检索会话内的历史对话"""
+    if message_fts_enabled:
+        # 使用消息表的 FTS5 全文索引检索
+        db = get_db()
+        try:
+            return search_session_turns(db, session_id, query, k)
+        finally:
+            db.close()
+    # SQLite 不支持 trigram 分词时，使用增量维护的 BM25 索引
+    with session_db(session_id) as collection:
+        ensure_bm25_index(session_id, collection)
+    return bm25_store.search(session_id, query, k)
+
+def reciprocal_rank_fusion(result_lists: List[Dict[str, List]], k: int) -> Dict[str, List]:
+    """倒数排名融合（RRF）：按轮次合并多路检索结果，得分为各路 1/(RRF_K + 排名) 之和"""
+    scores = {}
+    entries = {}
+    for results in result_lists:
+        for rank, (doc, meta) in enumerate(zip(results['documents'], results['metadatas'])):
+            turn = meta.get('turn')
+            scores[turn] = scores.get(turn, 0.0) + 1.0 / (RRF_K + rank + 1)
+            entries.setdefault(turn, (doc, meta))
+    top_turns = sorted(scores, key=scores.get, reverse=True)[:k]
+    return {
+        'documents': [entries[turn][0] for turn in top_turns],
+        'metadatas': [entries[turn][1] for turn in top_turns]
+    }
+
+def search_previous_context(session_id: str, query: str, k: int = 3):
+    """搜索相关的历史对话（向量检索与 BM25 检索融合）"""
+    try:
+        deadline = time.monotonic() + RETRIEVAL_BUDGET_MS / 1000
+        vector_future = retrieval_executor.submit(vector_search, session_id, query, k * 2)
+
+        result_lists = [keyword_search(session_id, query, k * 2)]
+        try:
+            result_lists.append(vector_future.result(timeout=max(deadline - time.monotonic(), 0)))
+        except FutureTimeoutError:
+            print(f"Vector search exceeded {RETRIEVAL_BUDGET_MS}ms budget, using keyword results only")
+        except Exception as e:
+            print(f"Vector search error: {e}")
+
+        return reciprocal_rank_fusion(result_lists, k)
+    except Exception as e:
+        print(f"Context search error: {e}")
+        return None
+
+CHAT_SYSTEM_PROMPT = """
 # 角色
 你是一位耐心细致的数学老师，擅长逐步引导学生解答各类数学题目，以生动易懂的方式讲解解题方法，帮助学生真正掌握数学知识。
 
@@ -430,7 +932,94 @@ async def chat_endpoint(
 - 只讨论与数学题目和解题方法相关的内容，拒绝回答与数学无关的话题。
 - 所输出的内容必须严格按照 markdown 格式进行组织，不能偏离框架要求。
 - 巩固题目和解答不能超过 150 字。
-"""}]
+"""
+
+# 会话历史的 token 预算和原样保留的最近轮数，更早的轮次并入滚动摘要
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 6000))
+CONTEXT_KEEP_TURNS = int(os.environ.get("CONTEXT_KEEP_TURNS", 6))
+
+SUMMARY_PROMPT = """你是一位数学老师的助手。请把已有的对话摘要和新增的师生对话合并成一份新的摘要，要求：
+1. 保留题目原文中的关键条件、已完成的解题步骤和结论、学生的疑问和薄弱点
+2. 公式使用 LaTeX 表示
+3. 不超过 300 字
+请直接输出摘要内容。"""
+
+def get_session_summary(session_id: str):
+    """读取会话的滚动摘要及其覆盖的轮数"""
+    db = get_db()
+    try:
+        row = db.execute(
+            "SELECT summary, summary_turns FROM session WHERE session_id = ?",
+            (session_id,)
+        ).fetchone()
+        if row is None:
+            return None, 0
+        return row['summary'], row['summary_turns'] or 0
+    finally:
+        db.close()
+
+def save_session_summary(session_id: str, summary: str, summary_turns: int):
+    db = get_db()
+    try:
+        db.execute(
+            "UPDATE session SET summary = ?, summary_turns = ? WHERE session_id = ?",
+            (summary, summary_turns, session_id)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+# 正在更新摘要的会话，避免同一会话并发更新
+summarizing_sessions = set()
+
+async def update_session_summary(session_id: str):
+    """后台任务：把最近几轮之前、尚未摘要的对话并入滚动摘要"""
+    if session_id in summarizing_sessions:
+        return
+    summarizing_sessions.add(session_id)
+    try:
+        summary, summary_turns = await run_in_threadpool(get_session_summary, session_id)
+        history = await run_in_threadpool(get_message_history, session_id)
+        turns = turns_to_summarize(history, summary_turns, CONTEXT_KEEP_TURNS)
+        if not turns:
+            return
+
+        content = f"已有摘要：\n{summary or '（无）'}\n\n新增对话：\n{format_turns(turns)}"
+        response = await create_chat_completion(
+            priority=Priority.BACKGROUND,
+            **models.request_kwargs("summarization"),
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": content}
+            ]
+        )
+        new_summary = response.choices[0].message.content.strip()
+        await run_in_threadpool(save_session_summary, session_id, new_summary, summary_turns + len(turns))
+    except Exception as e:
+        print(f"Summary update error: {e}")
+    finally:
+        summarizing_sessions.discard(session_id)
+
+def build_chat_messages(session_id: str, text: str, current_message: List[Dict]) -> List[Dict]:
+    """组装发送给模型的消息列表（系统提示、检索到的历史上下文、会话历史和当前消息）"""
+    # Check for temporal references and search context
+    context_message = ""
+    if session_id and contains_temporal_reference(text):
+        search_results = search_previous_context(session_id, text)
+        
+        if search_results and search_results['documents']:
+            print("\n=== Vector Search Results ===")
+            for doc, meta in zip(search_results['documents'], search_results['metadatas']):
+                print("Matched Document:", doc)
+                print("Metadata:", meta)  # 确保 meta 是字典
+                context_message += f"第{meta['turn']}轮对话：\n{doc}\n"
+            print("=========================\n")  # 输出分隔线
+
+    # Prepare messages with context
+    system_prompt = CHAT_SYSTEM_PROMPT
+    if FOLLOW_UP_MODE == "inline":
+        system_prompt += FOLLOW_UP_INSTRUCTION
+    messages = [{"role": "system", "content": system_prompt}]
 
     if context_message:
         messages.append({
@@ -438,55 +1027,249 @@ async def chat_endpoint(
             "content": f"以下是与当前问题相关的历史对话内容，请参考这些内容来回答问题：\n{context_message}"
         })
 
-    # 从数据库加载历史消息
-    messages.extend(get_message_history(session_id))
+    # 从数据库加载历史消息：较早的轮次用滚动摘要代替，并控制在 token 预算内
+    summary, summary_turns = get_session_summary(session_id)
+    messages.extend(build_history_messages(
+        get_message_history(session_id),
+        summary,
+        summary_turns,
+        keep_turns=CONTEXT_KEEP_TURNS,
+        token_budget=CONTEXT_TOKEN_BUDGET
+    ))
     
     # 添加当前用户消息
     messages.append({"role": "user", "content": current_message})
-    print('\n当前输入模型的消息 :',messages)
+
+    # 把图片引用替换为 base64 内容（只有仍保留图片的最近几轮会真正读取文件）
+    return inline_image_refs(messages, blob_store)
+
+def persist_chat_turn(session_id: str, text: str, current_message: List[Dict], assistant_response: str,
+                      user_id: Optional[str] = None):
+    """保存一轮对话：写入消息表并加入会话的向量库"""
+    # Combine Q&A into single document
+    qa_text = f"Question: {text}\nAnswer: {assistant_response}"
+
+    # 先分配轮号：消息表和向量库使用同一个轮号，两路检索结果可以按轮次融合。
+    # 轮数加一和向量索引任务在同一个事务中提交（一次 fsync）；向量计算和写入向量库由后台队列完成
+    db = get_db()
+    try:
+        with db:
+            turn = next_turn_number(db, session_id, user_id)
+            metadata = {
+                "turn": turn,
+                "timestamp": datetime.now().isoformat(),
+                "question": text
+            }
+            index_queue.enqueue(db, session_id, f"conv_{turn}", qa_text, metadata)
+    finally:
+        db.close()
+    index_queue.notify()
+
+    # 存储消息：两条一起入队，进入同一批次提交
+    futures = [
+        store_message(session_id, 'user', json.dumps(current_message, ensure_ascii=False), wait=False, turn=turn),
+        store_message(session_id, 'ai', assistant_response, wait=False, turn=turn)
+    ]
+    if MESSAGE_WRITE_STRICT:
+        for future in futures:
+            future.result()
+
+def index_session_turns(session_id: str, jobs: List[Dict]):
+    """后台队列的处理函数：把同一会话的若干轮对话一次写入向量库（upsert，重试时不会重复）"""
+    documents = [job["document"] for job in jobs]
+    embeddings = embed_texts(documents)
+    with session_db(session_id, get_session_user_id(session_id)) as collection:
+        if not message_fts_enabled:
+            ensure_bm25_index(session_id, collection)
+        collection.upsert(
+            documents=documents,
+            ids=[job["doc_id"] for job in jobs],
+            metadatas=[job["metadata"] for job in jobs],
+            embeddings=embeddings
+        )
+
+    # 未启用全文索引时同步更新 BM25 索引（全文索引由触发器维护）
+    if not message_fts_enabled:
+        for job in jobs:
+            bm25_store.add(session_id, job["doc_id"], job["document"], job["metadata"])
+
+# 向量索引队列（保存在数据库中，重启后继续处理）
+index_queue = VectorIndexQueue(
+    index_session_turns,
+    db_pool.db_path,
+    batch_size=int(os.environ.get("INDEX_QUEUE_BATCH_SIZE", "64")),
+    max_attempts=int(os.environ.get("INDEX_QUEUE_MAX_ATTEMPTS", "5"))
+)
+
+@app.on_event("startup")
+async def start_index_queue():
+    index_queue.start()
+
+@app.get("/index_queue/stats")
+async def index_queue_stats_endpoint():
+    """向量索引队列深度和处理统计"""
+    return await run_in_threadpool(index_queue.stats)
+
+def sse_event(event: str, data) -> str:
+    """格式化一条 Server-Sent Events 消息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# 正在生成的流式回答；客户端断开后生成任务继续运行直到落库，这里保留引用避免任务被回收
+streaming_turns = set()
+
+async def stream_chat_events(session_id: str, text: str, current_message: List[Dict], messages: List[Dict],
+                             user_id: Optional[str] = None):
+    """以 SSE 形式逐段转发模型输出，结束后补发后续问题建议和 session_id
+
+    事件顺序：session -> delta（多条）-> follow_ups -> done；出错时发送 error 事件。
+    模型输出在独立的任务中生成并落库，客户端中途断开（响应生成器被取消）时完整的回答仍会保存。
+    """
+    yield sse_event("session", {"session_id": session_id})
+
+    events: asyncio.Queue = asyncio.Queue()
+    disconnected = asyncio.Event()
+    task = asyncio.create_task(generate_streamed_turn(
+        events, disconnected, session_id, text, current_message, messages, user_id
+    ))
+    streaming_turns.add(task)
+    task.add_done_callback(streaming_turns.discard)
+    try:
+        while True:
+            event = await events.get()
+            if event is None:
+                return
+            yield event
+    finally:
+        disconnected.set()
+
+async def generate_streamed_turn(events: asyncio.Queue, disconnected: asyncio.Event, session_id: str, text: str,
+                                 current_message: List[Dict], messages: List[Dict], user_id: Optional[str]):
+    """流式调用模型，把 SSE 事件放入 events（None 表示结束），回答完成后落库"""
+    try:
+        # 只推送回答正文，末尾 <wenti> 标签中的后续问题在 follow_ups 事件中发送
+        parser = FollowUpStreamParser()
+        try:
+            async for delta in stream_chat_completion(
+                priority=Priority.INTERACTIVE,
+                **models.request_kwargs(chat_task(messages)),
+                messages=messages
+            ):
+                content = parser.feed(delta)
+                if content:
+                    events.put_nowait(sse_event("delta", {"content": content}))
+        except Exception as e:
+            print(f"Stream error: {e}")
+            events.put_nowait(sse_event("error", {"detail": str(e)}))
+            return
+
+        remaining, follow_up_questions = parser.finish()
+        if remaining:
+            events.put_nowait(sse_event("delta", {"content": remaining}))
+        assistant_response = parser.answer
+        print("\n用户: ", json.dumps(current_message, ensure_ascii=False, indent=2))
+        print("\n助手: ", clean_message_content(assistant_response))
+        print("-" * 50)
+
+        # 先落库，保证客户端收到 done 时这一轮已经可查
+        await run_in_threadpool(persist_chat_turn, session_id, text, current_message, assistant_response, user_id)
+
+        # 客户端已断开时不再生成后续问题
+        if not follow_up_questions and not disconnected.is_set():
+            try:
+                follow_up_questions = await generate_follow_up_questions(assistant_response)
+            except Exception as e:
+                print(f"Follow-up generation error: {e}")
+                follow_up_questions = []
+        events.put_nowait(sse_event("follow_ups", {"follow_up_suggestions": follow_up_questions}))
+        events.put_nowait(sse_event("done", {"session_id": session_id}))
+    except Exception as e:
+        print(f"Error saving streamed turn of session {session_id}: {e}")
+        events.put_nowait(sse_event("error", {"detail": str(e)}))
+    finally:
+        events.put_nowait(None)
+
+@app.post("/chat")
+async def chat_endpoint(
+    background_tasks: BackgroundTasks,
+    text: str = Form(...),
+    image_url: Optional[str] = Form(None),
+    image_file: Optional[UploadFile] = File(None),
+    session_id: Optional[str] = Form(None),
+    user_id: Optional[str] = Form(None),
+    stream: bool = Form(False)
+):
+    # 验证参数
+    if session_id is None and not user_id:
+        raise HTTPException(status_code=400, detail="Must provide user_id for new session")
+        
+    # 如果没有session_id，创建新会话
+    if session_id is None:
+        session_id = await run_in_threadpool(create_new_session, user_id)
+    
+    # 准备当前消息
+    current_message = [{"type": "text", "text": text}]
+
+    # 图片按内容哈希存入 BlobStore，消息中只保存引用，发送给模型时再内联
+
+    # 处理图片URL
+    if image_url:
+        image_content = await run_in_threadpool(download_image, image_url)
+        if image_content:
+            file_extension = image_url.split('.')[-1].lower()
+            mime_type = f"image/{file_extension}" if file_extension in ["png", "jpg", "jpeg", "gif", "webp"] else "image"
+            sha256 = await run_in_threadpool(blob_store.put, image_content)
+            current_message.append(make_image_ref(sha256, mime_type))
+
+    # 处理上传的图片文件
+    elif image_file:
+        image_content = await image_file.read()
+        sha256 = await run_in_threadpool(blob_store.put, image_content)
+        current_message.append(make_image_ref(sha256, f"image/{image_file.filename.split('.')[-1]}"))
+
+    # 检索、读库等同步操作放到线程池，避免阻塞事件循环
+    messages = await run_in_threadpool(build_chat_messages, session_id, text, current_message)
+    # 发送给模型的消息中图片已内联为 base64，日志只记录消息条数和当前消息（图片为引用）
+    print(f'\n当前输入模型的消息 : {len(messages)} 条，当前消息 :', current_message)
+
+    # 流式模式：边生成边推送，首字延迟只取决于模型的首个 token
+    if stream:
+        # 流结束后执行（FastAPI 会把 background_tasks 挂到返回的响应上）
+        background_tasks.add_task(update_session_summary, session_id)
+        return StreamingResponse(
+            stream_chat_events(session_id, text, current_message, messages, user_id),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
     # 调用API获取回复
-    response = client.chat.completions.create(
-        model="ep-20250105222308-5f4lk",
+    response = await create_chat_completion(
+        priority=Priority.INTERACTIVE,
+        **models.request_kwargs(chat_task(messages)),
         messages=messages
     )
 
     assistant_response = response.choices[0].message.content
+    follow_up_questions = []
+    if FOLLOW_UP_MODE == "inline":
+        assistant_response, follow_up_questions = split_follow_ups(assistant_response)
     
     # 存储消息前先清理内容
     print("\n用户: ", json.dumps(current_message, ensure_ascii=False, indent=2))
     print("\n助手: ", clean_message_content(assistant_response))
     print("-" * 50)
     
-    # 生成后续问题建议
-    follow_up_questions = generate_follow_up_questions(assistant_response)
-    print(follow_up_questions)
-    # 存储消息
-    store_message(session_id, 'user', json.dumps(current_message, ensure_ascii=False))
-    store_message(session_id, 'ai', assistant_response)
-
-    # Store in vector database
-    collection = get_session_db(session_id)
-    conv_count = get_conversation_count(collection)
-    
-    # Combine Q&A into single document
-    qa_text = f"Question: {text}\nAnswer: {assistant_response}"
-    
-    # Store in ChromaDB
-    collection.add(
-        documents=[qa_text],
-        ids=[f"conv_{conv_count + 1}"],
-        metadatas=[{
-            "turn": conv_count + 1,
-            "timestamp": datetime.now().isoformat(),
-            "question": text,
-            "answer": assistant_response
-        }]
-    )
+    await run_in_threadpool(persist_chat_turn, session_id, text, current_message, assistant_response, user_id)
+
+    # 没有随回答一起给出的后续问题在响应返回后生成，客户端通过 /chat/{session_id}/follow_ups 获取
+    follow_up_id = schedule_follow_ups(background_tasks, assistant_response, session_id, follow_up_questions)
+    background_tasks.add_task(update_session_summary, session_id)
 
     return {
         "session_id": session_id,
         "response": assistant_response,
-        "follow_up_suggestions": follow_up_questions
+        "follow_up_suggestions": follow_up_questions,
+        "follow_up_id": follow_up_id,
+        "follow_ups_ready": bool(follow_up_questions)
     }
 
 @app.delete("/chat/{session_id}")
@@ -503,12 +1286,17 @@ async def clear_chat_history(session_id: str):
             (session_id,)
         )
         db.commit()
+        if session_store_resource.loaded:
+            session_store_resource.get().evict(session_id)
+        bm25_store.evict(session_id)
+        history_cache.invalidate(session_id)
         return {"message": "Chat session marked as completed"}
     finally:
         db.close()
 
 @app.post("/generate_by_knowledge")
 async def generate_by_knowledge(
+    background_tasks: BackgroundTasks,
     knowledge_points: List[str] = Body(...),
     history_questions: Optional[List[str]] = Body(None)
 ):
@@ -548,6 +1336,11 @@ async def generate_by_knowledge(
 [最终答案]
 </daan>"""
     }
+    if FOLLOW_UP_MODE == "inline":
+        prompt["content"] += f"""
+<{FOLLOW_UP_TAG}>
+[学生做完这道题后可能会问的 3 个后续问题，每行一个，每个不超过 20 字]
+</{FOLLOW_UP_TAG}>"""
     
     # 构建用户消息
     knowledge_points_str = ', '.join(knowledge_points)
@@ -561,14 +1354,24 @@ async def generate_by_knowledge(
         {"role": "user", "content": user_message}
     ]
     
-    try:
-        # 调用AI生成题目
-        response = client.chat.completions.create(
-            model="ep-20250105222308-5f4lk",
+    async def call():
+        response = await create_chat_completion(
+            priority=Priority.GENERATION,
+            hedge=True,
+            **models.request_kwargs("question_generation"),
             messages=messages
         )
-        
-        generated_content = response.choices[0].message.content
+        return response.choices[0].message.content
+
+    try:
+        # 调用AI生成题目；同一知识点的并发请求共用一次调用，题目解析和后续问题仍按请求各自处理
+        if KNOWLEDGE_COALESCE_SCOPE == "off":
+            generated_content = await call()
+        else:
+            key_payload = {"knowledge_points": sorted(p.strip() for p in knowledge_points)}
+            if KNOWLEDGE_COALESCE_SCOPE != "knowledge":
+                key_payload["history_questions"] = sorted(q.strip() for q in history_questions or [])
+            generated_content = await inflight.do(make_key("generate_by_knowledge", key_payload), call)
         
         # 使用更简单的字符串处理方法提取内容
         def extract_content(text, tag):
@@ -585,12 +1388,18 @@ async def generate_by_knowledge(
             "knowledge_points": knowledge_points
         }
         
-        # 生成后续练习建议
-        follow_up = generate_follow_up_questions(generated_content)
-        result["follow_up_suggestions"] = follow_up
+        # 后续练习建议随题目一起生成；未按格式给出时在后台生成，通过 /follow_ups/{follow_up_id} 获取
+        follow_up_questions = []
+        if FOLLOW_UP_MODE == "inline":
+            generated_content, follow_up_questions = split_follow_ups(generated_content)
+        result["follow_up_suggestions"] = follow_up_questions
+        result["follow_up_id"] = schedule_follow_ups(background_tasks, generated_content, suggestions=follow_up_questions)
+        result["follow_ups_ready"] = bool(follow_up_questions)
         
         return result
         
+    except UpstreamUnavailableError:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
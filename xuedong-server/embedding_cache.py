@@ -0,0 +1,173 @@
+import os
+import re
+import fcntl
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+KEY_BYTES = 16
+
+
+def normalize_text(text: str) -> str:
+    """归一化文本：合并连续空白并去除首尾空白，使仅空白不同的文本共用缓存"""
+    return ' '.join(text.split())
+
+
+class EmbeddingCache:
+    """按内容哈希缓存的文本向量
+
+    键为 sha256(模型名 + 归一化文本) 的前 16 字节。两级存储：
+    - 内存：最近使用的 memory_entries 条向量（LRU）
+    - 磁盘：定长记录（16 字节键 + dim 个 float32）追加写入 vectors.bin，
+      通过 numpy.memmap 读取，重启后无需重新计算
+
+    多个进程可以共用同一文件：截断和追加都在文件的 flock 排他锁内进行，
+    因此截断时不会有其他进程的追加正在进行，追加的起始位置总是对齐记录边界。
+    每个进程只索引自己加载时已有的和自己写入的记录。
+    """
+
+    def __init__(self, model_name: str, dim: int, path: Optional[str] = None, memory_entries: int = 10000):
+        self.model_name = model_name
+        self.dim = dim
+        self.memory_entries = memory_entries
+        self.record_dtype = np.dtype([("key", f"S{KEY_BYTES}"), ("vector", "<f4", (dim,))])
+        self._memory: "OrderedDict[bytes, List[float]]" = OrderedDict()
+        self._rows: Dict[bytes, int] = {}
+        self._mmap = None
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.file_path = None
+        if path:
+            directory = os.path.join(path, re.sub(r"[^\w.-]", "_", model_name))
+            os.makedirs(directory, exist_ok=True)
+            self.file_path = os.path.join(directory, "vectors.bin")
+            self._load()
+
+    def _key(self, text: str) -> bytes:
+        payload = f"{self.model_name}\0{normalize_text(text)}".encode("utf-8")
+        return hashlib.sha256(payload).digest()[:KEY_BYTES]
+
+    def _truncate_partial(self, fd: int) -> int:
+        """截掉末尾不完整的记录（上次写入中途崩溃留下的），返回完整记录数
+
+        必须在持有 flock 排他锁时调用：此时没有其他进程正在追加，不完整的记录只可能来自崩溃的写入。
+        不截断的话之后追加的记录都会错位，行号对应到别的文本的向量。
+        """
+        size = os.fstat(fd).st_size
+        count, partial = divmod(size, self.record_dtype.itemsize)
+        if partial:
+            print(f"Truncating {partial} bytes of incomplete record from {self.file_path}")
+            os.ftruncate(fd, count * self.record_dtype.itemsize)
+        return count
+
+    def _load(self):
+        """扫描磁盘文件建立 键 -> 行号 索引"""
+        if not os.path.exists(self.file_path):
+            return
+        fd = os.open(self.file_path, os.O_WRONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            count = self._truncate_partial(fd)
+        finally:
+            os.close(fd)
+        if count == 0:
+            return
+        self._mmap = np.memmap(self.file_path, dtype=self.record_dtype, mode="r", shape=(count,))
+        for row, key in enumerate(self._mmap["key"]):
+            self._rows[bytes(key)] = row
+
+    def _read_disk(self, row: int) -> Optional[List[float]]:
+        """读取一行向量；行号超出文件末尾时返回 None（按未命中处理）"""
+        if self._mmap is None or row >= len(self._mmap):
+            count = os.path.getsize(self.file_path) // self.record_dtype.itemsize
+            if row >= count:
+                return None
+            self._mmap = np.memmap(self.file_path, dtype=self.record_dtype, mode="r", shape=(count,))
+        return self._mmap[row]["vector"].tolist()
+
+    def _remember(self, key: bytes, vector: List[float]):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get_many(self, texts: List[str]) -> Tuple[List[Optional[List[float]]], List[int]]:
+        """批量查询缓存
+
+        Returns:
+            Tuple: (与 texts 对应的向量列表，未命中处为 None；未命中的下标列表)
+        """
+        vectors: List[Optional[List[float]]] = []
+        missing: List[int] = []
+        with self._lock:
+            for i, text in enumerate(texts):
+                key = self._key(text)
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                else:
+                    if key in self._rows:
+                        vector = self._read_disk(self._rows[key])
+                    if vector is not None:
+                        self._remember(key, vector)
+                        self.disk_hits += 1
+                if vector is None:
+                    missing.append(i)
+                    self.misses += 1
+                vectors.append(vector)
+        return vectors, missing
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]):
+        """写入新计算的向量，同时追加到磁盘文件"""
+        with self._lock:
+            new_keys = []
+            new_vectors = []
+            for text, vector in zip(texts, vectors):
+                key = self._key(text)
+                self._remember(key, vector)
+                if self.file_path and key not in self._rows:
+                    new_keys.append(key)
+                    new_vectors.append(vector)
+            if not new_keys:
+                return
+
+            records = np.zeros(len(new_keys), dtype=self.record_dtype)
+            records["key"] = new_keys
+            records["vector"] = np.asarray(new_vectors, dtype=np.float32)
+            # 持有排他锁后以 O_APPEND 写入，多个进程共用同一文件时记录不会交错；
+            # 写入后文件偏移即本批记录的末尾，据此得到起始行号（关闭文件时释放锁）
+            data = records.tobytes()
+            fd = os.open(self.file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                self._truncate_partial(fd)
+                written = os.write(fd, data)
+                end = os.lseek(fd, 0, os.SEEK_CUR)
+            finally:
+                os.close(fd)
+            start, misaligned = divmod(end - len(data), self.record_dtype.itemsize)
+            if written != len(data) or misaligned:
+                # 写入不完整或起始位置没有对齐记录边界：不建立索引，这些向量只保留在内存中
+                print(f"Skipping disk index for {len(new_keys)} embeddings: misaligned write to {self.file_path}")
+                return
+            for offset, key in enumerate(new_keys):
+                self._rows[key] = start + offset
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "disk_entries": len(self._rows),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            }
@@ -0,0 +1,155 @@
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Dict, List, Optional
+
+from sentence_transformers import SentenceTransformer
+
+from embedding_cache import EmbeddingCache, normalize_text
+
+
+def load_model(model_name: str, backend: str = "torch") -> SentenceTransformer:
+    """加载向量模型
+
+    Args:
+        model_name (str): 模型名称
+        backend (str): torch（默认）、onnx（ONNX Runtime）或 int8（对 Linear 层做动态 int8 量化，仅 CPU）
+    """
+    if backend == "onnx":
+        return SentenceTransformer(model_name, backend="onnx", device="cpu")
+
+    model = SentenceTransformer(model_name, device="cpu" if backend == "int8" else None)
+    if backend == "int8":
+        import torch
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif backend != "torch":
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    return model
+
+
+class EmbeddingService:
+    """合并并发请求的批量向量计算服务
+
+    各请求线程调用 encode() 后进入队列，后台线程取出第一条请求后最多再等待 max_wait_ms，
+    把期间到达的请求（不超过 max_batch_size 条文本）合成一批交给模型计算，再把结果分发回去。
+    并发请求多时一次前向计算处理多条文本，延迟基本不随并发数线性增长。
+    """
+
+    def __init__(self, model: SentenceTransformer, max_batch_size: int = 64, max_wait_ms: float = 5,
+                 cache: Optional[EmbeddingCache] = None):
+        self.model = model
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue" = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=1000)
+        self._requests = 0
+        self._texts = 0
+        self._batches = 0
+        self._encode_seconds = 0.0
+        self._started_at = time.monotonic()
+        self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._worker.start()
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        """计算文本向量（阻塞直到所在批次完成），命中缓存的文本不再计算"""
+        if not texts:
+            return []
+        if self.cache is None:
+            return self._submit(list(texts))
+
+        vectors, missing = self.cache.get_many(texts)
+        if missing:
+            # 缓存键是归一化后的文本，计算向量也用归一化后的文本，
+            # 仅空白不同的输入得到同一个向量，与谁先被计算无关
+            missing_texts = [normalize_text(texts[i]) for i in missing]
+            computed = self._submit(missing_texts)
+            self.cache.put_many(missing_texts, computed)
+            for i, vector in zip(missing, computed):
+                vectors[i] = vector
+        return vectors
+
+    def _submit(self, texts: List[str]) -> List[List[float]]:
+        future: Future = Future()
+        self._queue.put((texts, future, time.monotonic()))
+        return future.result()
+
+    def close(self):
+        self._queue.put(None)
+
+    def _collect_batch(self, first) -> list:
+        batch = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # 关闭信号放回队列，处理完当前批次后退出
+                self._queue.put(None)
+                break
+            batch.append(item)
+            size += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect_batch(first)
+            texts = [text for item in batch for text in item[0]]
+
+            start = time.monotonic()
+            try:
+                vectors = self.model.encode(texts, batch_size=self.max_batch_size).tolist()
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.monotonic()
+
+            offset = 0
+            for item_texts, future, enqueued_at in batch:
+                future.set_result(vectors[offset:offset + len(item_texts)])
+                offset += len(item_texts)
+
+            with self._stats_lock:
+                self._batches += 1
+                self._requests += len(batch)
+                self._texts += len(texts)
+                self._encode_seconds += finished - start
+                self._latencies.extend(finished - item[2] for item in batch)
+
+    def stats(self) -> Dict:
+        """吞吐和延迟统计（延迟为最近 1000 个批量请求，从入队到得到结果；不含命中缓存的请求）"""
+        with self._stats_lock:
+            latencies = sorted(self._latencies)
+            elapsed = time.monotonic() - self._started_at
+
+            def percentile(p: float) -> float:
+                if not latencies:
+                    return 0.0
+                return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+            return {
+                "requests": self._requests,
+                "texts": self._texts,
+                "batches": self._batches,
+                "avg_batch_size": self._texts / self._batches if self._batches else 0.0,
+                "queue_depth": self._queue.qsize(),
+                "texts_per_second": self._texts / elapsed if elapsed else 0.0,
+                "encode_seconds": self._encode_seconds,
+                "latency_ms_p50": percentile(0.5),
+                "latency_ms_p95": percentile(0.95),
+                "latency_ms_max": latencies[-1] * 1000 if latencies else 0.0,
+                "cache": self.cache.stats() if self.cache else None
+            }
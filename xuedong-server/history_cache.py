@@ -0,0 +1,105 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List
+
+# 每条消息除内容外的估算开销（dict、时间戳等）
+MESSAGE_OVERHEAD_BYTES = 200
+
+
+class HistoryCache:
+    """按会话缓存解析后的历史消息，LRU 淘汰，总大小不超过 max_bytes
+
+    - load() 未命中时从数据库读取并放入缓存；
+    - store_message 写入消息时调用 append() 直接追加到已缓存的会话（write-through）；
+    - 读取数据库期间该会话有新消息写入时，本次读取结果不放入缓存，避免缓存缺少这条消息。
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._bytes = 0
+        self._loading: Dict[str, int] = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def load(self, session_id: str, loader: Callable[[], List[Dict]]) -> List[Dict]:
+        """返回会话历史（列表为副本，可以修改），未命中时调用 loader 读取"""
+        with self._lock:
+            messages = self._entries.get(session_id)
+            if messages is not None:
+                self._entries.move_to_end(session_id)
+                self._hits += 1
+                return list(messages)
+            self._misses += 1
+            self._loading[session_id] = self._loading.get(session_id, 0) + 1
+
+        loaded = None
+        try:
+            loaded = loader()
+        finally:
+            with self._lock:
+                self._loading[session_id] -= 1
+                dirty = session_id in self._dirty
+                if not self._loading[session_id]:
+                    del self._loading[session_id]
+                    self._dirty.discard(session_id)
+                if loaded is not None and not dirty and session_id not in self._entries:
+                    self._put(session_id, list(loaded))
+        return loaded
+
+    def append(self, session_id: str, message: Dict, size: int):
+        """追加一条新消息；未缓存的会话不做处理，下次读取时从数据库加载
+
+        消息在入队写入之后才追加，期间可能已经提交并被一次读取放入缓存，
+        此时 message_id 已经补上，按 message_id 跳过重复的消息。
+        """
+        with self._lock:
+            if session_id in self._loading:
+                self._dirty.add(session_id)
+            messages = self._entries.get(session_id)
+            if messages is None:
+                return
+            message_id = message.get("message_id")
+            if message_id is not None and any(m.get("message_id") == message_id for m in reversed(messages)):
+                return
+            messages.append(message)
+            self._sizes[session_id] += size + MESSAGE_OVERHEAD_BYTES
+            self._bytes += size + MESSAGE_OVERHEAD_BYTES
+            self._entries.move_to_end(session_id)
+            self._evict()
+
+    def invalidate(self, session_id: str):
+        with self._lock:
+            if session_id in self._loading:
+                self._dirty.add(session_id)
+            if self._entries.pop(session_id, None) is not None:
+                self._bytes -= self._sizes.pop(session_id)
+
+    def _put(self, session_id: str, messages: List[Dict]):
+        size = sum(len(str(m['content'])) + MESSAGE_OVERHEAD_BYTES for m in messages)
+        if size > self.max_bytes:
+            return
+        self._entries[session_id] = messages
+        self._sizes[session_id] = size
+        self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            session_id, _ = self._entries.popitem(last=False)
+            self._bytes -= self._sizes.pop(session_id)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "sessions": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / total if total else 0.0
+            }
@@ -0,0 +1,222 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from typing import Callable, Dict, List, Optional
+
+from database import connect
+
+# 待写入向量库的问答轮次，保存在业务数据库中，服务重启后继续处理
+INDEX_QUEUE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS vector_index_queue (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        doc_id TEXT NOT NULL,
+        document TEXT NOT NULL,
+        metadata TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt_at REAL,
+        last_error TEXT,
+        enqueued_at REAL NOT NULL,
+        claimed_by TEXT,
+        claimed_at REAL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_vector_index_queue_next ON vector_index_queue(next_attempt_at)",
+]
+
+# 建表之后新增的列（多进程领取任务用）
+INDEX_QUEUE_ADDED_COLUMNS = [('claimed_by', 'TEXT'), ('claimed_at', 'REAL')]
+
+
+def ensure_index_queue(conn: sqlite3.Connection):
+    """创建向量索引队列表，已有的表补齐新增的列"""
+    for statement in INDEX_QUEUE_SCHEMA:
+        conn.execute(statement)
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(vector_index_queue)").fetchall()}
+    for name, definition in INDEX_QUEUE_ADDED_COLUMNS:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE vector_index_queue ADD COLUMN {name} {definition}")
+    conn.commit()
+
+
+class VectorIndexQueue:
+    """异步写入向量库的持久化队列
+
+    persist_chat_turn 只把问答轮次写入 vector_index_queue 表即返回，后台线程按 job_id 顺序领取
+    最多 batch_size 条，按会话分组后交给 handler 一次写入（一次向量计算、一次 upsert），成功后删除。
+    失败的任务按指数退避重试，超过 max_attempts 次后保留在表中（next_attempt_at 置空）供排查。
+
+    领取任务用一条 UPDATE ... RETURNING 写入 claimed_by/claimed_at，多个进程共用同一个数据库时
+    每个任务只会被一个进程处理；领取后超过 claim_seconds 仍未完成（进程退出）的任务可以被重新领取。
+
+    检索只会晚几毫秒看到最新一轮，而最新一轮本身已经在对话历史中。
+    """
+
+    def __init__(self, handler: Callable[[str, List[Dict]], None], db_path: Optional[str] = None,
+                 batch_size: int = 64, poll_seconds: float = 1.0, max_attempts: int = 5,
+                 retry_base_seconds: float = 2.0, claim_seconds: float = 300):
+        """
+        Args:
+            handler (callable): handler(session_id, jobs)，jobs 为 {"doc_id", "document", "metadata"} 列表；
+                必须是幂等的（例如使用 upsert），重试时同一批任务可能再次传入
+            db_path (str): 数据库路径
+            batch_size (int): 每次最多取出的任务数
+            poll_seconds (float): 没有新任务时检查待重试任务的间隔
+            max_attempts (int): 最多尝试次数
+            retry_base_seconds (float): 第一次重试的等待时间，之后每次翻倍
+            claim_seconds (float): 领取的任务超过该时间未完成时允许其他进程重新领取
+        """
+        self.handler = handler
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.poll_seconds = poll_seconds
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.claim_seconds = claim_seconds
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self._indexed = 0
+        self._failures = 0
+        self._last_lag: Optional[float] = None
+
+    def enqueue(self, conn: sqlite3.Connection, session_id: str, doc_id: str, document: str, metadata: Dict):
+        """在调用方的事务中写入一条任务（不提交，与调用方的其他写入共用一次提交）
+
+        提交后调用 notify() 唤醒后台线程。
+        """
+        conn.execute(
+            """
+            INSERT INTO vector_index_queue (session_id, doc_id, document, metadata, next_attempt_at, enqueued_at)
+            VALUES (?, ?, ?, ?, 0, ?)
+            """,
+            (session_id, doc_id, document, json.dumps(metadata, ensure_ascii=False), time.time())
+        )
+
+    def notify(self):
+        """有新任务提交，立即处理"""
+        self._wake.set()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name="vector-indexer", daemon=True)
+            self._worker.start()
+
+    def stop(self, timeout: float = 10):
+        """处理完当前批次后停止，未处理的任务留在表中，下次启动继续"""
+        self._stopped.set()
+        self._wake.set()
+        if self._worker is not None:
+            self._worker.join(timeout)
+
+    def _run(self):
+        conn = connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        try:
+            while not self._stopped.is_set():
+                try:
+                    self._poll(conn)
+                except Exception as e:
+                    print(f"Error in vector indexer: {e}")
+                    self._stopped.wait(self.poll_seconds)
+        finally:
+            conn.close()
+
+    def _claim(self, conn: sqlite3.Connection) -> list:
+        """领取最多 batch_size 个到期且未被其他进程领取（或领取已过期）的任务"""
+        now = time.time()
+        with conn:
+            rows = conn.execute(
+                """
+                UPDATE vector_index_queue SET claimed_by = ?, claimed_at = ?
+                WHERE job_id IN (
+                    SELECT job_id FROM vector_index_queue
+                    WHERE next_attempt_at <= ? AND (claimed_at IS NULL OR claimed_at < ?)
+                    ORDER BY job_id
+                    LIMIT ?
+                )
+                RETURNING job_id, session_id, doc_id, document, metadata, attempts, enqueued_at
+                """,
+                (self.worker_id, now, now, now - self.claim_seconds, self.batch_size)
+            ).fetchall()
+        return sorted(rows, key=lambda row: row['job_id'])
+
+    def _poll(self, conn: sqlite3.Connection):
+        self._wake.clear()
+        rows = self._claim(conn)
+        if not rows:
+            self._wake.wait(self.poll_seconds)
+            return
+
+        groups: Dict[str, list] = {}
+        for row in rows:
+            groups.setdefault(row['session_id'], []).append(row)
+        for session_id, group in groups.items():
+            self._process(conn, session_id, group)
+
+    def _process(self, conn: sqlite3.Connection, session_id: str, rows: list):
+        jobs = [
+            {"doc_id": row['doc_id'], "document": row['document'], "metadata": json.loads(row['metadata'])}
+            for row in rows
+        ]
+        job_ids = [(row['job_id'], self.worker_id) for row in rows]
+        try:
+            self.handler(session_id, jobs)
+        except Exception as e:
+            print(f"Error indexing {len(jobs)} turns of session {session_id}: {e}")
+            now = time.time()
+            updates = []
+            for row in rows:
+                attempts = row['attempts'] + 1
+                if attempts >= self.max_attempts:
+                    print(f"Giving up indexing {row['doc_id']} of session {session_id} after {attempts} attempts")
+                    next_attempt_at = None
+                else:
+                    next_attempt_at = now + self.retry_base_seconds * 2 ** (attempts - 1)
+                updates.append((attempts, next_attempt_at, str(e), row['job_id'], self.worker_id))
+            with conn:
+                conn.executemany(
+                    """
+                    UPDATE vector_index_queue
+                    SET attempts = ?, next_attempt_at = ?, last_error = ?, claimed_by = NULL, claimed_at = NULL
+                    WHERE job_id = ? AND claimed_by = ?
+                    """,
+                    updates
+                )
+            with self._stats_lock:
+                self._failures += len(rows)
+            return
+
+        with conn:
+            conn.executemany("DELETE FROM vector_index_queue WHERE job_id = ? AND claimed_by = ?", job_ids)
+        with self._stats_lock:
+            self._indexed += len(rows)
+            self._last_lag = time.time() - rows[-1]['enqueued_at']
+
+    def stats(self) -> Dict:
+        """队列深度（待处理/已放弃）及处理统计"""
+        conn = connect(self.db_path)
+        try:
+            pending, failed = conn.execute(
+                """
+                SELECT COUNT(next_attempt_at), COUNT(*) - COUNT(next_attempt_at)
+                FROM vector_index_queue
+                """
+            ).fetchone()
+        finally:
+            conn.close()
+        with self._stats_lock:
+            return {
+                "pending": pending,
+                "failed": failed,
+                "indexed": self._indexed,
+                "failures": self._failures,
+                "last_lag_ms": self._last_lag * 1000 if self._last_lag is not None else None,
+                "running": self._worker is not None and self._worker.is_alive()
+            }
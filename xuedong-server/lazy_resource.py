@@ -0,0 +1,54 @@
+import time
+import threading
+from typing import Callable, Dict, Optional
+
+
+class LazyResource:
+    """按需加载的重量级资源（模型、向量库等）
+
+    第一次调用 get() 时才执行 factory，并发调用只会加载一次；
+    也可以在启动后由后台任务提前调用 warm_up() 预热，不阻塞服务端口。
+    """
+
+    def __init__(self, name: str, factory: Callable):
+        self.name = name
+        self.factory = factory
+        self._value = None
+        self._loaded = False
+        self._error: Optional[str] = None
+        self._load_seconds: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def get(self):
+        if self._loaded:
+            return self._value
+        with self._lock:
+            if not self._loaded:
+                start = time.monotonic()
+                try:
+                    self._value = self.factory()
+                except Exception as e:
+                    self._error = str(e)
+                    raise
+                self._load_seconds = time.monotonic() - start
+                self._error = None
+                self._loaded = True
+        return self._value
+
+    def warm_up(self):
+        """预热；失败时记录错误，不向外抛出"""
+        try:
+            self.get()
+        except Exception as e:
+            print(f"Failed to load {self.name}: {e}")
+
+    def status(self) -> Dict:
+        return {
+            "ready": self._loaded,
+            "load_seconds": self._load_seconds,
+            "error": self._error
+        }
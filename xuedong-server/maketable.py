@@ -1,14 +1,121 @@
-import sqlite3
-from contextlib import contextmanager
 import os
+from message_search import ensure_message_fts
+from index_queue import ensure_index_queue
+from database import DEFAULT_DB_PATH, get_db_connection
 
-@contextmanager
-def get_db_connection(db_path):
-    conn = sqlite3.connect(db_path)
-    try:
-        yield conn
-    finally:
-        conn.close()
+# 建表之后新增的列，已有数据库通过 migrate_database 补齐
+ADDED_COLUMNS = {
+    'session': [
+        ('summary', 'TEXT'),
+        ('summary_turns', 'INTEGER DEFAULT 0'),
+        ('message_count', 'INTEGER DEFAULT 0'),
+        ('preview', 'TEXT'),
+        # 已保存的对话轮数，用作向量库的 conv_{n} id；已有会话按用户消息数补齐
+        ('turn_count', 'INTEGER DEFAULT 0',
+         "UPDATE session SET turn_count = (SELECT COUNT(*) FROM message m "
+         "WHERE m.session_id = session.session_id AND m.sender_type = 'user')"),
+    ],
+    'message': [
+        # 消息所属的对话轮号，与 session.turn_count 和向量库 id 同一来源；已有消息按此前的用户消息数补齐
+        ('turn', 'INTEGER',
+         "UPDATE message SET turn = (SELECT COUNT(*) FROM message u "
+         "WHERE u.session_id = message.session_id AND u.sender_type = 'user' "
+         "AND u.message_id <= message.message_id)"),
+    ],
+}
+
+# 会话列表用到的消息数、预览（第一条用户消息的前 50 个字）和最后活跃时间，
+# 由 message 表上的触发器维护，列出会话时不再聚合消息表
+PREVIEW_SQL = """
+(SELECT CASE WHEN length(p) > 50 THEN substr(p, 1, 50) || '...' ELSE p END
+ FROM (SELECT CASE
+     WHEN json_valid({content}) AND json_type({content}) = 'array' THEN
+         COALESCE((SELECT json_extract(value, '$.text')
+                   FROM json_each({content})
+                   WHERE json_extract(value, '$.type') = 'text'
+                   LIMIT 1), '')
+     ELSE {content}
+ END AS p))
+"""
+
+SESSION_STATS_SCHEMA = [
+    f"""
+    CREATE TRIGGER IF NOT EXISTS session_stats_insert AFTER INSERT ON message BEGIN
+        UPDATE session SET
+            message_count = COALESCE(message_count, 0) + 1,
+            last_active_at = new.timestamp,
+            preview = CASE
+                WHEN preview IS NULL AND new.sender_type = 'user' THEN {PREVIEW_SQL.format(content='new.content')}
+                ELSE preview
+            END
+        WHERE session_id = new.session_id;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS session_stats_delete AFTER DELETE ON message BEGIN
+        UPDATE session SET message_count = MAX(COALESCE(message_count, 0) - 1, 0)
+        WHERE session_id = old.session_id;
+    END
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_session_user_start ON session(user_id, start_time)",
+]
+
+SESSION_STATS_BACKFILL_SQL = f"""
+UPDATE session SET
+    message_count = (SELECT COUNT(*) FROM message m WHERE m.session_id = session.session_id),
+    last_active_at = COALESCE(
+        (SELECT MAX(m.timestamp) FROM message m WHERE m.session_id = session.session_id),
+        last_active_at
+    ),
+    preview = (SELECT {PREVIEW_SQL.format(content='m.content')}
+               FROM message m
+               WHERE m.session_id = session.session_id AND m.sender_type = 'user'
+               ORDER BY m.timestamp, m.message_id
+               LIMIT 1)
+"""
+
+def ensure_session_stats(conn):
+    """创建维护会话统计列的触发器和索引，首次创建时根据已有消息补齐统计值"""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'session_stats_insert'"
+    ).fetchone()
+    for statement in SESSION_STATS_SCHEMA:
+        conn.execute(statement)
+    if not exists:
+        conn.execute(SESSION_STATS_BACKFILL_SQL)
+    conn.commit()
+
+# 建表之后新增的索引；(session_id, timestamp) 支持按会话分页读取消息，
+# 取代只有 session_id 的旧索引
+ADDED_INDEXES = {
+    'message': [
+        ('idx_message_session_time', '(session_id, timestamp)'),
+    ],
+}
+DROPPED_INDEXES = ['idx_message_session']
+
+def migrate_database(conn):
+    """为已有数据库补齐新增的列和索引"""
+    cursor = conn.cursor()
+    for table, columns in ADDED_COLUMNS.items():
+        cursor.execute(f"PRAGMA table_info({table})")
+        existing = {row[1] for row in cursor.fetchall()}
+        if not existing:
+            continue
+        for name, definition, *backfill in columns:
+            if name not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+                for statement in backfill:
+                    cursor.execute(statement)
+    for table, indexes in ADDED_INDEXES.items():
+        cursor.execute(f"PRAGMA table_info({table})")
+        if not cursor.fetchall():
+            continue
+        for name, columns in indexes:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}{columns}")
+    for name in DROPPED_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+    conn.commit()
 
 def init_database(db_path='your_database.db'):
     """Initialize the database and create all necessary tables"""
@@ -30,7 +137,12 @@ def init_database(db_path='your_database.db'):
             status TEXT DEFAULT 'active',
             created_at DATETIME DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
             updated_at DATETIME DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
-            last_active_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            last_active_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            summary TEXT,
+            summary_turns INTEGER DEFAULT 0,
+            message_count INTEGER DEFAULT 0,
+            preview TEXT,
+            turn_count INTEGER DEFAULT 0
         )
         ''')
 
@@ -45,6 +157,7 @@ def init_database(db_path='your_database.db'):
             intent TEXT,
             created_at DATETIME DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
             updated_at DATETIME DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime')),
+            turn INTEGER,
             FOREIGN KEY (session_id) REFERENCES session(session_id)
         )
         ''')
@@ -92,12 +205,24 @@ def init_database(db_path='your_database.db'):
         ''')
 
         # Create indexes for better query performance
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_session ON message(session_id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_session_time ON message(session_id, timestamp)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_session_knowledge_session ON session_knowledge(session_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_session_knowledge_knowledge ON session_knowledge(knowledge_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_knowledge_user ON user_knowledge(user_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_knowledge_knowledge ON user_knowledge(knowledge_id)')
 
+        # Add columns introduced after the tables were first created
+        migrate_database(conn)
+
+        # Maintain per-session message count / preview / last activity on insert
+        ensure_session_stats(conn)
+
+        # Create full-text index over message text (kept in sync by triggers)
+        ensure_message_fts(conn)
+
+        # Create the durable queue of turns waiting to be written to the vector store
+        ensure_index_queue(conn)
+
         # Insert some initial knowledge points (optional)
         initial_knowledge = [
             ('三角函数', '包括正弦、余弦、正切等三角函数的概念和应用'),
@@ -116,7 +241,7 @@ def init_database(db_path='your_database.db'):
 
 def main():
     """Main function to initialize the database"""
-    db_path = 'tty.db'
+    db_path = DEFAULT_DB_PATH
     try:
         init_database(db_path)
         print(f"Successfully initialized database at {db_path}")
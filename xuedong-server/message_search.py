@@ -0,0 +1,181 @@
+import sqlite3
+from typing import Dict, List, Optional
+
+# 消息全文索引：trigram 分词按任意连续 3 个字符建索引，不依赖空格，
+# 适合中文和 LaTeX 公式；由触发器与 message 表保持同步。
+# 用户消息的 content 是 JSON 数组，只索引其中的文本部分，跳过图片数据。
+MESSAGE_TEXT_SQL = """
+CASE
+    WHEN {row}.sender_type = 'user' AND json_valid({row}.content) AND json_type({row}.content) = 'array' THEN
+        (SELECT group_concat(json_extract(value, '$.text'), ' ')
+         FROM json_each({row}.content)
+         WHERE json_extract(value, '$.type') = 'text')
+    ELSE {row}.content
+END
+"""
+
+FTS_SCHEMA = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+        text,
+        tokenize = 'trigram'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN
+        INSERT INTO message_fts(rowid, text) VALUES (new.message_id, {MESSAGE_TEXT_SQL.format(row='new')});
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN
+        DELETE FROM message_fts WHERE rowid = old.message_id;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content, sender_type ON message BEGIN
+        DELETE FROM message_fts WHERE rowid = old.message_id;
+        INSERT INTO message_fts(rowid, text) VALUES (new.message_id, {MESSAGE_TEXT_SQL.format(row='new')});
+    END
+    """,
+]
+
+# trigram 分词的最短可检索长度
+MIN_QUERY_LENGTH = 3
+
+
+def ensure_message_fts(conn: sqlite3.Connection) -> bool:
+    """创建全文索引表和同步触发器，首次创建时为已有消息补建索引
+
+    Returns:
+        bool: 当前 SQLite 是否支持 FTS5 trigram 分词（需要 3.34 及以上版本）
+    """
+    try:
+        exists = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'message_fts'"
+        ).fetchone()
+        for statement in FTS_SCHEMA:
+            conn.execute(statement)
+        if not exists:
+            conn.execute(
+                f"INSERT INTO message_fts(rowid, text) SELECT m.message_id, {MESSAGE_TEXT_SQL.format(row='m')} FROM message m"
+            )
+        conn.commit()
+        return True
+    except sqlite3.OperationalError as e:
+        print(f"FTS5 trigram index unavailable: {e}")
+        conn.rollback()
+        return False
+
+
+def build_match_query(query: str) -> Optional[str]:
+    """把自然语言查询拆成 3 字符片段，用 OR 组合成 FTS5 查询；过短时返回 None"""
+    text = ''.join(query.split())
+    if len(text) < MIN_QUERY_LENGTH:
+        return None
+    grams = dict.fromkeys(text[i:i + 3] for i in range(len(text) - 2))
+    return ' OR '.join('"' + gram.replace('"', '""') + '"' for gram in grams)
+
+
+def search_session_turns(conn: sqlite3.Connection, session_id: str, query: str, k: int = 3) -> Dict[str, List]:
+    """在会话内检索相关的问答轮次
+
+    全文检索限定在该会话的 message_id 范围内（FTS5 直接按 rowid 范围读取倒排表），
+    不会先匹配所有用户的消息再按会话过滤。命中的消息按轮次（message.turn，与向量库同一轮号）
+    取最佳 bm25 得分，同一查询中补全为“问题+回答”，返回与向量库检索相同的结构。
+    """
+    results = {'documents': [], 'metadatas': []}
+    match = build_match_query(query)
+    if match is None:
+        return results
+
+    first_id, last_id = conn.execute(
+        "SELECT MIN(message_id), MAX(message_id) FROM message WHERE session_id = ?",
+        (session_id,)
+    ).fetchone()
+    if first_id is None:
+        return results
+
+    rows = conn.execute(
+        """
+        WITH hits AS (
+            SELECT m.turn, f.rank AS score
+            FROM message_fts f
+            JOIN message m ON m.message_id = f.rowid
+            WHERE message_fts MATCH ? AND f.rowid BETWEEN ? AND ?
+              AND m.session_id = ? AND m.turn IS NOT NULL
+        ), ranked AS (
+            SELECT turn, MIN(score) AS score
+            FROM hits
+            GROUP BY turn
+            ORDER BY score
+            LIMIT ?
+        )
+        SELECT r.turn, qf.text, a.content, a.timestamp
+        FROM ranked r
+        LEFT JOIN message q ON q.message_id = (
+            SELECT MIN(message_id) FROM message
+            WHERE session_id = ? AND turn = r.turn AND sender_type = 'user'
+        )
+        LEFT JOIN message_fts qf ON qf.rowid = q.message_id
+        LEFT JOIN message a ON a.message_id = (
+            SELECT MIN(message_id) FROM message
+            WHERE session_id = ? AND turn = r.turn AND sender_type != 'user'
+        )
+        ORDER BY r.score
+        """,
+        (match, first_id, last_id, session_id, k, session_id, session_id)
+    ).fetchall()
+
+    for turn, question_text, answer_text, timestamp in rows:
+        question_text = question_text or ''
+        results['documents'].append(f"Question: {question_text}\nAnswer: {answer_text or ''}")
+        results['metadatas'].append({
+            "turn": turn,
+            "timestamp": timestamp,
+            "question": question_text
+        })
+    return results
+
+
+def search_user_messages(conn: sqlite3.Connection, user_id: str, query: str, limit: int = 20) -> List[Dict]:
+    """在用户所有会话中检索其提过的问题，按相关度排序"""
+    match = build_match_query(query)
+    if match is not None:
+        rows = conn.execute(
+            """
+            SELECT m.message_id, m.session_id, m.timestamp, f.text
+            FROM message_fts f
+            JOIN message m ON m.message_id = f.rowid
+            JOIN session s ON s.session_id = m.session_id
+            WHERE message_fts MATCH ? AND s.user_id = ? AND m.sender_type = 'user'
+            ORDER BY bm25(message_fts)
+            LIMIT ?
+            """,
+            (match, user_id, limit)
+        ).fetchall()
+    else:
+        # 少于 3 个字符无法使用 trigram 索引，退化为子串匹配
+        rows = conn.execute(
+            """
+            SELECT m.message_id, m.session_id, m.timestamp, f.text
+            FROM message_fts f
+            JOIN message m ON m.message_id = f.rowid
+            JOIN session s ON s.session_id = m.session_id
+            WHERE instr(f.text, ?) > 0 AND s.user_id = ? AND m.sender_type = 'user'
+            ORDER BY m.message_id DESC
+            LIMIT ?
+            """,
+            (query.strip(), user_id, limit)
+        ).fetchall()
+
+    messages = []
+    for message_id, session_id, timestamp, text in rows:
+        text = text or ''
+        messages.append({
+            "message_id": message_id,
+            "session_id": session_id,
+            "timestamp": timestamp,
+            # trigram 的 snippet() 会把重叠片段重复输出，这里直接截取原文
+            "text": text[:100] + '...' if len(text) > 100 else text
+        })
+    return messages
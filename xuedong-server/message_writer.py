@@ -0,0 +1,174 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from database import connect
+
+INSERT_MESSAGE_SQL = """
+INSERT INTO message (session_id, sender_type, content, timestamp, turn)
+VALUES (?, ?, ?, ?, ?)
+"""
+
+
+def current_timestamp() -> str:
+    """与表中默认值 strftime('%Y-%m-%d %H:%M:%f', 'now', 'localtime') 相同格式的本地时间"""
+    now = datetime.now()
+    return now.strftime('%Y-%m-%d %H:%M:%S.') + f"{now.microsecond // 1000:03d}"
+
+
+class MessageWriter:
+    """合并提交的消息写入队列
+
+    请求线程调用 submit() 把消息放入队列后立即返回；后台线程取出第一条消息后最多再等待
+    max_wait_ms，把期间到达的消息（不超过 max_batch_size 条）放在同一个事务中提交，
+    多个请求共用一次 fsync。
+
+    - 只有一个写线程且按入队顺序插入，同一会话的消息顺序与调用顺序一致；
+    - 时间戳在入队时确定，不受排队延迟影响；
+    - 需要立即读到写入结果的调用方可以等待 submit() 返回的 Future，或调用 wait_session()；
+    - close() 会先写完队列中剩余的消息。队列在内存中，进程崩溃或被强制结束时，已入队但未提交的消息会丢失，
+      需要持久性保证的调用方必须等待 Future 完成后再向客户端确认。
+    """
+
+    def __init__(self, db_path: Optional[str] = None, max_batch_size: int = 256, max_wait_ms: float = 10):
+        self.db_path = db_path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue" = queue.Queue()
+        self._pending_lock = threading.Lock()
+        self._pending: Dict[str, Future] = {}
+        self._stats_lock = threading.Lock()
+        self._messages = 0
+        self._batches = 0
+        self._errors = 0
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="message-writer", daemon=True)
+        self._worker.start()
+
+    def submit(self, session_id: str, sender_type: str, content: str, timestamp: Optional[str] = None,
+               on_commit: Optional[Callable[[int], None]] = None, turn: Optional[int] = None) -> Future:
+        """把消息放入写入队列，返回在消息提交后完成的 Future（结果为 message_id）
+
+        入队本身不是持久化的，Future 完成后消息才真正写入数据库；写入失败时 Future 以异常完成。
+
+        Args:
+            timestamp (str): 消息时间，为空时使用入队时间
+            on_commit (callable): 提交后、Future 完成前在写线程中以 message_id 调用
+            turn (int): 消息所属的对话轮号（与向量库的 conv_{turn} 一致）
+        """
+        if self._closed:
+            raise RuntimeError("MessageWriter is closed")
+        future: Future = Future()
+        with self._pending_lock:
+            self._pending[session_id] = future
+        future.add_done_callback(lambda f: self._clear_pending(session_id, f))
+        self._queue.put((session_id, sender_type, content, timestamp or current_timestamp(), turn, future, on_commit))
+        return future
+
+    def _clear_pending(self, session_id: str, future: Future):
+        with self._pending_lock:
+            if self._pending.get(session_id) is future:
+                del self._pending[session_id]
+
+    def wait_session(self, session_id: str, timeout: Optional[float] = None):
+        """等待该会话已入队的消息全部提交（按顺序写入，等最后一条即可）"""
+        with self._pending_lock:
+            future = self._pending.get(session_id)
+        if future is not None:
+            try:
+                future.result(timeout)
+            except Exception as e:
+                print(f"Error waiting for messages of session {session_id}: {e}")
+
+    def flush(self, timeout: Optional[float] = None):
+        """等待当前队列中的消息全部提交"""
+        future: Future = Future()
+        self._queue.put(future)
+        future.result(timeout)
+
+    def close(self):
+        """写完剩余消息后停止写线程"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect_batch(self, first) -> list:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None or isinstance(item, Future):
+                # 关闭或 flush 信号放回队列，提交当前批次后再处理
+                self._queue.put(item)
+                break
+            batch.append(item)
+        return batch
+
+    def _write_batch(self, conn, batch: list):
+        try:
+            with conn:
+                ids = [conn.execute(INSERT_MESSAGE_SQL, item[:5]).lastrowid for item in batch]
+        except Exception as e:
+            # 整批失败时逐条重试，避免一条坏数据连累同批的其他消息
+            print(f"Error writing message batch, retrying one by one: {e}")
+            ids = []
+            for item in batch:
+                try:
+                    with conn:
+                        ids.append(conn.execute(INSERT_MESSAGE_SQL, item[:5]).lastrowid)
+                except Exception as item_error:
+                    print(f"Error storing message for session {item[0]}: {item_error}")
+                    ids.append(item_error)
+
+        errors = 0
+        for item, result in zip(batch, ids):
+            if isinstance(result, Exception):
+                item[5].set_exception(result)
+                errors += 1
+            else:
+                if item[6] is not None:
+                    try:
+                        item[6](result)
+                    except Exception as e:
+                        print(f"Error in on_commit callback: {e}")
+                item[5].set_result(result)
+
+        with self._stats_lock:
+            self._batches += 1
+            self._messages += len(batch) - errors
+            self._errors += errors
+
+    def _run(self):
+        conn = connect(self.db_path)
+        try:
+            while True:
+                first = self._queue.get()
+                if first is None:
+                    return
+                if isinstance(first, Future):
+                    first.set_result(None)
+                    continue
+                self._write_batch(conn, self._collect_batch(first))
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {
+                "messages": self._messages,
+                "batches": self._batches,
+                "avg_batch_size": self._messages / self._batches if self._batches else 0.0,
+                "errors": self._errors,
+                "queue_depth": self._queue.qsize()
+            }
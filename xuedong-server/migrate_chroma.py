@@ -0,0 +1,100 @@
+import argparse
+import os
+import shutil
+import chromadb
+
+from database import DEFAULT_DB_PATH, connect
+from vector_store import SharedVectorStore, close_client
+
+
+def get_session_owners(db_path: str) -> dict:
+    """读取 session_id -> user_id 映射，用于补充元数据"""
+    if not os.path.exists(db_path):
+        return {}
+    conn = connect(db_path)
+    try:
+        return dict(conn.execute("SELECT session_id, user_id FROM session").fetchall())
+    finally:
+        conn.close()
+
+
+def migrate_session(store: SharedVectorStore, session_dir: str, session_id: str, user_id: str = None) -> int:
+    """把一个会话目录中的全部轮次写入共享向量库，返回迁移的条数
+
+    沿用原有的向量，不重新计算；去掉与文档内容重复的 answer 元数据。
+    使用 upsert，重复执行不会产生重复记录。
+    """
+    client = chromadb.PersistentClient(path=session_dir)
+    try:
+        try:
+            collection = client.get_collection(name="chat_history")
+        except Exception:
+            return 0
+
+        results = collection.get(include=["documents", "metadatas", "embeddings"])
+        if not results["ids"]:
+            return 0
+
+        metadatas = []
+        for metadata in results["metadatas"]:
+            metadata = dict(metadata or {})
+            metadata.pop("answer", None)
+            metadata["session_id"] = session_id
+            if user_id:
+                metadata["user_id"] = user_id
+            metadatas.append(metadata)
+
+        store.collection_for(session_id).upsert(
+            ids=[f"{session_id}:{i}" for i in results["ids"]],
+            documents=results["documents"],
+            metadatas=metadatas,
+            embeddings=results["embeddings"]
+        )
+        return len(results["ids"])
+    finally:
+        # 每个会话目录用完立即关闭，否则文件句柄和内存随目录数增长，--delete 时也会删除仍打开的文件
+        close_client(client)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将 ./chroma_dbs 下按会话划分的向量库合并到共享向量库")
+    parser.add_argument("--source", default="./chroma_dbs", help="按会话划分的向量库目录")
+    parser.add_argument("--target", default="./chroma_shared", help="共享向量库目录")
+    parser.add_argument("--shards", type=int, default=1, help="共享 collection 数量，需与服务端 CHROMA_SHARDS 一致")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="用于查询会话所属用户的数据库")
+    parser.add_argument("--delete", action="store_true", help="迁移成功后删除原会话目录")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.source):
+        print(f"目录 '{args.source}' 不存在")
+        return
+
+    store = SharedVectorStore(path=args.target, shards=args.shards)
+    owners = get_session_owners(args.db)
+
+    total_sessions = 0
+    total_turns = 0
+    for name in sorted(os.listdir(args.source)):
+        if not name.endswith(".db"):
+            continue
+        session_id = name[:-len(".db")]
+        session_dir = os.path.join(args.source, name)
+        try:
+            count = migrate_session(store, session_dir, session_id, owners.get(session_id))
+        except Exception as e:
+            print(f"迁移会话 {session_id} 失败: {e}")
+            continue
+
+        total_sessions += 1
+        total_turns += count
+        print(f"{session_id}: {count} 条")
+        if args.delete:
+            shutil.rmtree(session_dir)
+
+    store.close_all()
+    print(f"\n共迁移 {total_sessions} 个会话，{total_turns} 条对话")
+    print("设置 VECTOR_STORE_MODE=shared 后服务端将使用共享向量库")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import json
+import sqlite3
+
+from database import DEFAULT_DB_PATH, connect
+from blob_store import BlobStore, externalize_data_uris
+
+
+def migrate_messages(conn: sqlite3.Connection, store: BlobStore, batch_size: int = 200) -> int:
+    """把消息中内联的 base64 图片移入 BlobStore，返回改写的消息条数
+
+    只处理 content 中含 data URI 的用户消息；重复执行不会产生重复文件。
+    """
+    migrated = 0
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT message_id, content FROM message "
+            "WHERE message_id > ? AND sender_type = 'user' AND instr(content, ';base64,') > 0 "
+            "ORDER BY message_id LIMIT ?",
+            (last_id, batch_size)
+        ).fetchall()
+        if not rows:
+            return migrated
+
+        for message_id, content in rows:
+            last_id = message_id
+            try:
+                items = json.loads(content)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(items, list):
+                continue
+            new_items = externalize_data_uris(items, store)
+            if new_items != items:
+                conn.execute(
+                    "UPDATE message SET content = ? WHERE message_id = ?",
+                    (json.dumps(new_items, ensure_ascii=False), message_id)
+                )
+                migrated += 1
+        conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="将消息表中内联的 base64 图片迁移到按内容寻址的图片存储")
+    parser.add_argument("--db", default=DEFAULT_DB_PATH, help="数据库文件")
+    parser.add_argument("--blobs", default="./blobs", help="图片存储目录，需与服务端 BLOB_STORE_PATH 一致")
+    parser.add_argument("--vacuum", action="store_true", help="迁移后执行 VACUUM 回收空间")
+    args = parser.parse_args()
+
+    store = BlobStore(args.blobs)
+    conn = connect(args.db)
+    try:
+        count = migrate_messages(conn, store)
+        print(f"共迁移 {count} 条消息")
+        if args.vacuum:
+            conn.execute("VACUUM")
+            print("VACUUM 完成")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import os
+import json
+from typing import Dict, List, Optional
+
+# 默认使用的模型接入点（支持图片的大模型），未配置的任务都使用它
+DEFAULT_ENDPOINT = "ep-20250105222308-5f4lk"
+
+# 服务中调用模型的任务
+TASKS = ["chat", "vision_chat", "follow_ups", "question_generation", "grading", "summarization"]
+
+# 每个任务可配置的字段
+TASK_FIELDS = {"endpoint", "timeout", "max_tokens"}
+
+
+class ModelRegistry:
+    """按任务选择模型接入点
+
+    配置文件格式（JSON）：
+        {
+            "default": {"endpoint": "ep-xxx", "timeout": 120},
+            "tasks": {
+                "follow_ups": {"endpoint": "ep-yyy", "timeout": 20, "max_tokens": 200},
+                ...
+            }
+        }
+    任务配置中未填写的字段沿用 default；环境变量 ARK_ENDPOINT_<TASK>（如 ARK_ENDPOINT_FOLLOW_UPS）
+    可以覆盖单个任务的接入点。
+    """
+
+    def __init__(self, config: Optional[Dict] = None):
+        config = config or {}
+        unknown = set(config.get("tasks", {})) - set(TASKS)
+        if unknown:
+            raise ValueError(f"Unknown model tasks in config: {sorted(unknown)}")
+
+        default = {"endpoint": DEFAULT_ENDPOINT, "timeout": None, "max_tokens": None}
+        default.update(self._validate("default", config.get("default", {})))
+
+        self.tasks: Dict[str, Dict] = {}
+        for task in TASKS:
+            settings = dict(default)
+            settings.update(self._validate(task, config.get("tasks", {}).get(task, {})))
+            endpoint = os.environ.get(f"ARK_ENDPOINT_{task.upper()}")
+            if endpoint:
+                settings["endpoint"] = endpoint
+            self.tasks[task] = settings
+
+    @staticmethod
+    def _validate(name: str, settings: Dict) -> Dict:
+        unknown = set(settings) - TASK_FIELDS
+        if unknown:
+            raise ValueError(f"Unknown fields for model task '{name}': {sorted(unknown)}")
+        return settings
+
+    @classmethod
+    def from_file(cls, path: str) -> "ModelRegistry":
+        """从 JSON 配置文件加载，文件不存在时全部任务使用默认接入点"""
+        if not path or not os.path.exists(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            return cls(json.load(f))
+
+    def request_kwargs(self, task: str) -> Dict:
+        """返回调用模型时使用的参数（model、timeout、max_tokens）"""
+        settings = self.tasks[task]
+        kwargs = {"model": settings["endpoint"]}
+        if settings["timeout"] is not None:
+            kwargs["timeout"] = settings["timeout"]
+        if settings["max_tokens"] is not None:
+            kwargs["max_tokens"] = settings["max_tokens"]
+        return kwargs
+
+    def to_dict(self) -> Dict[str, Dict]:
+        return {task: dict(settings) for task, settings in self.tasks.items()}
+
+
+def has_images(messages: List[Dict]) -> bool:
+    """消息中是否包含图片（包括历史消息中保留的图片）"""
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list) and any(item.get("type") in ("image_url", "image_ref") for item in content):
+            return True
+    return False
+
+
+def chat_task(messages: List[Dict]) -> str:
+    """含图片的对话使用 vision_chat，纯文字对话使用 chat"""
+    return "vision_chat" if has_images(messages) else "chat"
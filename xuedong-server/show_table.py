@@ -2,12 +2,13 @@ from tabulate import tabulate
 import sqlite3
 from contextlib import contextmanager
 import os
+from database import DEFAULT_DB_PATH, connect
 
 @contextmanager
 def get_db_connection(db_path):
     if not os.path.exists(db_path):
         raise FileNotFoundError(f"数据库文件 '{db_path}' 不存在")
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path)
     try:
         yield conn
     finally:
@@ -113,20 +114,23 @@ def show_message_table(db_path='your_database.db', page_size=10):
                 selected_cols = headers
                 col_query = '*'
             
+            # 按 message_id 游标翻页（WHERE message_id > ?），翻到后面的页也不需要扫描前面的行
             current_page = 0
+            start_after = 0
             while True:
                 # 清屏（根据操作系统可能需要调整）
                 print('\033[2J\033[H')
                 
-                # 获取当前页的数据
-                offset = current_page * page_size
-                cursor.execute(f"SELECT {col_query} FROM message LIMIT ? OFFSET ?", 
-                             (page_size, offset))
+                # 获取当前页的数据（额外取出 message_id 作为下一页的游标）
+                cursor.execute(f"SELECT message_id, {col_query} FROM message WHERE message_id > ? ORDER BY message_id LIMIT ?", 
+                             (start_after, page_size))
                 rows = cursor.fetchall()
                 
                 if not rows:
                     print("没有更多数据了")
                     break
+                last_id = rows[-1][0]
+                rows = [row[1:] for row in rows]
                 
                 # 显示表格
                 print("\n" + "="*60)
@@ -142,33 +146,41 @@ def show_message_table(db_path='your_database.db', page_size=10):
                 print("n: 下一页")
                 print("p: 上一页")
                 print("q: 退出")
-                print("g <页码>: 跳转到指定页")
+                print("g <消息ID>: 跳转到指定消息所在位置")
                 
                 cmd = input("\n请输入命令: ").strip().lower()
                 if cmd == 'q':
                     break
                 elif cmd == 'n':
-                    if (current_page + 1) * page_size < total_rows:
+                    cursor.execute("SELECT 1 FROM message WHERE message_id > ? LIMIT 1", (last_id,))
+                    if cursor.fetchone():
+                        start_after = last_id
                         current_page += 1
                 elif cmd == 'p':
-                    if current_page > 0:
-                        current_page -= 1
+                    # 从当前页起点往前倒取一页
+                    cursor.execute(
+                        "SELECT MIN(message_id) FROM (SELECT message_id FROM message WHERE message_id <= ? ORDER BY message_id DESC LIMIT ?)",
+                        (start_after, page_size))
+                    first_id = cursor.fetchone()[0]
+                    if first_id is not None:
+                        start_after = first_id - 1
+                        current_page = max(current_page - 1, 0)
                 elif cmd.startswith('g '):
                     try:
-                        page = int(cmd.split()[1]) - 1
-                        if 0 <= page * page_size < total_rows:
-                            current_page = page
-                        else:
-                            print("页码超出范围！")
+                        message_id = int(cmd.split()[1])
+                        # 跳转后重新计算页码：统计之前的行数（走主键，不读取行内容）
+                        cursor.execute("SELECT COUNT(*) FROM message WHERE message_id < ?", (message_id,))
+                        current_page = cursor.fetchone()[0] // page_size
+                        start_after = message_id - 1
                     except:
-                        print("无效的页码！")
+                        print("无效的消息ID！")
                 
     except Exception as e:
         print(f"错误: {e}")
 
 def main():
     # 可以修改为你的数据库文件路径
-    db_path = 'tty.db'
+    db_path = DEFAULT_DB_PATH
     try:
         # 显示所有表
         show_tables(db_path)
@@ -181,4 +193,4 @@ def main():
 
 if __name__ == "__main__":
     main()
-    # show_message_table('tty.db', page_size=10)
\ No newline at end of file
+    # show_message_table(DEFAULT_DB_PATH, page_size=10)
\ No newline at end of file
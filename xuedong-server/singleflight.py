@@ -0,0 +1,63 @@
+import json
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict
+
+
+def make_key(namespace: str, payload: Any) -> str:
+    """请求内容的规范化哈希：JSON 序列化时按键排序，相同内容得到相同的键
+
+    列表中元素顺序不影响含义时，调用方应先排序再传入。
+    """
+    data = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return f"{namespace}:{hashlib.sha256(data.encode('utf-8')).hexdigest()}"
+
+
+class SingleFlight:
+    """合并并发的相同请求（singleflight）
+
+    同一个键已有调用在进行时，后来的请求不再调用模型，而是等待这次调用的结果；
+    调用结束（成功或失败）后立即移除，之后的请求重新调用，因此不会返回过期结果。
+
+    调用在独立的任务中执行：发起调用的请求被取消（客户端断开）时，其他等待同一结果的请求不受影响。
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._calls = 0
+        self._coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Args:
+            key (str): 请求的键，见 make_key
+            fn (callable): 没有进行中的调用时执行的协程函数
+
+        Returns:
+            fn 的返回值（等待同一调用的请求得到同一个对象，不应修改）
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            self._calls += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self._coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            # 所有等待者都已取消时避免 "exception was never retrieved" 警告
+            task.exception()
+
+    def stats(self) -> Dict:
+        total = self._calls + self._coalesced
+        return {
+            "inflight": len(self._inflight),
+            "calls": self._calls,
+            "coalesced": self._coalesced,
+            "coalesced_rate": self._coalesced / total if total else 0.0
+        }
@@ -0,0 +1,91 @@
+import re
+from typing import List, Tuple
+
+# 回答末尾附带的后续问题段落，与 generate_by_knowledge 的 <timu>/<jiexi>/<daan> 一样用标签分隔
+FOLLOW_UP_TAG = "wenti"
+
+FOLLOW_UP_INSTRUCTION = f"""
+## 后续问题
+回答结束后，另起一行输出 3 个以学生视角提出的后续问题，要求简短具体、与本次回答高度相关、有助于加深理解，每个不超过 20 字。
+格式如下（标签必须放在全部回答内容之后，标签内每行一个问题，不要编号）：
+<{FOLLOW_UP_TAG}>
+<第一个后续问题>
+<第二个后续问题>
+<第三个后续问题>
+</{FOLLOW_UP_TAG}>
+"""
+
+MAX_FOLLOW_UPS = 5
+LIST_MARKER_PATTERN = re.compile(r'^(\d+\s*[.)、．]|[-*•])\s*')
+
+
+def parse_follow_ups(text: str, tag: str = FOLLOW_UP_TAG) -> List[str]:
+    """解析标签内的问题列表，容忍缺少结束标签和编号、列表符号"""
+    text = text.split(f"</{tag}>", 1)[0]
+    questions = []
+    for line in text.split('\n'):
+        line = LIST_MARKER_PATTERN.sub('', line.strip()).strip()
+        if line:
+            questions.append(line)
+    return questions[:MAX_FOLLOW_UPS]
+
+
+class FollowUpStreamParser:
+    """从流式输出中分离回答正文和末尾的后续问题
+
+    feed() 返回可以立即推送给客户端的正文；遇到可能是开始标签前缀的结尾时先暂存，
+    确认不是标签后再输出，因此客户端不会看到半截标签。开始标签之后的内容全部视为后续问题。
+    """
+
+    def __init__(self, tag: str = FOLLOW_UP_TAG):
+        self.tag = tag
+        self.open_tag = f"<{tag}>"
+        self._pending = ""
+        self._answer: List[str] = []
+        self._follow_up_text = None
+
+    def feed(self, delta: str) -> str:
+        if self._follow_up_text is not None:
+            self._follow_up_text += delta
+            return ""
+
+        text = self._pending + delta
+        pos = text.find(self.open_tag)
+        if pos >= 0:
+            output = text[:pos]
+            self._follow_up_text = text[pos + len(self.open_tag):]
+            self._pending = ""
+        else:
+            keep = self._partial_tag_length(text)
+            output = text[:len(text) - keep]
+            self._pending = text[len(text) - keep:]
+        self._answer.append(output)
+        return output
+
+    def _partial_tag_length(self, text: str) -> int:
+        """text 结尾与开始标签前缀重合的最大长度"""
+        for length in range(min(len(text), len(self.open_tag) - 1), 0, -1):
+            if text.endswith(self.open_tag[:length]):
+                return length
+        return 0
+
+    def finish(self) -> Tuple[str, List[str]]:
+        """结束解析，返回 (尚未输出的正文, 后续问题列表)"""
+        remaining, self._pending = self._pending, ""
+        self._answer.append(remaining)
+        if self._follow_up_text is None:
+            return remaining, []
+        return remaining, parse_follow_ups(self._follow_up_text, self.tag)
+
+    @property
+    def answer(self) -> str:
+        """已解析出的回答正文（不含后续问题）"""
+        return "".join(self._answer).rstrip()
+
+
+def split_follow_ups(text: str, tag: str = FOLLOW_UP_TAG) -> Tuple[str, List[str]]:
+    """把完整输出拆成 (回答正文, 后续问题列表)"""
+    parser = FollowUpStreamParser(tag)
+    parser.feed(text)
+    _, questions = parser.finish()
+    return parser.answer, questions
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 服务端模块都在 xuedong-server 根目录下，按脚本方式导入
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+import pytest
+
+from upstream_gateway import (
+    AdaptiveConcurrencyLimiter, CircuitBreaker, Priority, UpstreamGateway, UpstreamUnavailableError
+)
+
+
+async def started(task: asyncio.Task) -> bool:
+    """让出事件循环后检查 acquire 是否已经返回"""
+    await asyncio.sleep(0)
+    return task.done()
+
+
+def test_interactive_call_does_not_queue_behind_lower_priority_waiters():
+    async def scenario():
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=8, min_limit=1, max_limit=8)
+        # 后续问题最多占用一半名额：4 个在调用中，第 5 个排队
+        for _ in range(4):
+            await limiter.acquire(Priority.FOLLOW_UP)
+        queued_follow_up = asyncio.ensure_future(limiter.acquire(Priority.FOLLOW_UP))
+        assert not await started(queued_follow_up)
+
+        # 还有 4 个空闲名额，对话请求应立即开始
+        chat = asyncio.ensure_future(limiter.acquire(Priority.INTERACTIVE))
+        assert await started(chat)
+        assert limiter.stats()["inflight"] == 5
+
+        # 排队的后续问题仍要等后续问题的调用结束
+        assert not await started(queued_follow_up)
+        limiter.release()
+        assert not await started(queued_follow_up)
+        limiter.release()
+        limiter.release()
+        assert await started(queued_follow_up)
+
+    asyncio.run(scenario())
+
+
+def test_same_priority_waits_behind_queued_request():
+    async def scenario():
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=2, min_limit=1, max_limit=2)
+        await limiter.acquire(Priority.INTERACTIVE)
+        await limiter.acquire(Priority.INTERACTIVE)
+        first = asyncio.ensure_future(limiter.acquire(Priority.INTERACTIVE))
+        assert not await started(first)
+        second = asyncio.ensure_future(limiter.acquire(Priority.INTERACTIVE))
+        assert not await started(second)
+
+        limiter.release()
+        assert await started(first)
+        assert not await started(second)
+
+    asyncio.run(scenario())
+
+
+def test_higher_priority_waiter_is_served_first():
+    async def scenario():
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+        await limiter.acquire(Priority.INTERACTIVE)
+        background = asyncio.ensure_future(limiter.acquire(Priority.BACKGROUND))
+        chat = asyncio.ensure_future(limiter.acquire(Priority.INTERACTIVE))
+        assert not await started(background)
+        assert not await started(chat)
+
+        limiter.release()
+        assert await started(chat)
+        assert not await started(background)
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_at_head_does_not_block_new_requests():
+    async def scenario():
+        limiter = AdaptiveConcurrencyLimiter(initial_limit=1, min_limit=1, max_limit=1)
+        await limiter.acquire(Priority.INTERACTIVE)
+        waiter = asyncio.ensure_future(limiter.acquire(Priority.INTERACTIVE))
+        assert not await started(waiter)
+        waiter.cancel()
+        await asyncio.sleep(0)
+        limiter.release()
+
+        chat = asyncio.ensure_future(limiter.acquire(Priority.INTERACTIVE))
+        assert await started(chat)
+        assert limiter.stats()["inflight"] == 1
+
+    asyncio.run(scenario())
+
+
+class ServerError(Exception):
+    status_code = 503
+
+
+class FailingClient:
+    """chat.completions.create 总是返回 503 的假客户端"""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = self
+        self.completions = self
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        raise ServerError("unavailable")
+
+
+def test_retries_stop_once_breaker_opens():
+    async def scenario():
+        client = FailingClient()
+        breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=30, open_seconds=60)
+        gateway = UpstreamGateway(
+            client, AdaptiveConcurrencyLimiter(initial_limit=4), max_retries=5,
+            retry_base_seconds=0, breaker=breaker
+        )
+        with pytest.raises(UpstreamUnavailableError):
+            await gateway.create(Priority.INTERACTIVE, model="m", messages=[])
+        assert client.calls == 2
+        assert breaker.state == "open"
+
+    asyncio.run(scenario())
+
+
+def test_only_probe_result_closes_half_open_breaker():
+    breaker = CircuitBreaker(failure_rate=0.5, min_calls=2, window=30, open_seconds=0.01)
+    breaker.record(False)
+    breaker.record(False)
+    assert breaker.state == "open"
+    time.sleep(0.02)
+
+    assert breaker.check() is True
+    assert breaker.state == "half_open"
+    # 熔断前发出的调用现在才返回，不影响半开状态
+    breaker.record(True)
+    assert breaker.state == "half_open"
+    breaker.record(False)
+    assert breaker.state == "half_open"
+    with pytest.raises(UpstreamUnavailableError):
+        breaker.check()
+
+    breaker.record(True, probe=True)
+    assert breaker.state == "closed"
+    assert breaker.check() is False
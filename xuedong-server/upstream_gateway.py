@@ -0,0 +1,420 @@
+import time
+import heapq
+import random
+import asyncio
+import itertools
+from enum import IntEnum
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+
+class Priority(IntEnum):
+    """模型调用的优先级，数值越小越优先"""
+    INTERACTIVE = 0  # /chat 对话
+    GRADING = 1      # 批改作业
+    GENERATION = 2   # 按知识点出题
+    FOLLOW_UP = 3    # 后续问题建议
+    BACKGROUND = 4   # 滚动摘要等后台任务
+
+
+# 各优先级最多能占用当前并发上限的比例，低优先级的请求总会给对话留出余量
+PRIORITY_SHARES = {
+    Priority.INTERACTIVE: 1.0,
+    Priority.GRADING: 0.9,
+    Priority.GENERATION: 0.75,
+    Priority.FOLLOW_UP: 0.5,
+    Priority.BACKGROUND: 0.5,
+}
+
+
+def is_overload_error(error: Exception) -> bool:
+    """上游限流（429）、服务端错误（5xx）或超时，说明需要降低并发"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code is not None:
+        return status_code == 429 or status_code >= 500
+    return "timeout" in type(error).__name__.lower()
+
+
+def is_upstream_failure(error: Exception) -> bool:
+    """上游不可用：网络错误、超时或 5xx（4xx 是请求本身的问题，429 由并发控制处理）"""
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    return status_code is None or status_code >= 500
+
+
+class UpstreamUnavailableError(Exception):
+    """熔断器打开期间直接拒绝的调用"""
+
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"Model service is temporarily unavailable, retry in {retry_after:.0f}s")
+
+
+class CircuitBreaker:
+    """按最近一段时间的失败率熔断
+
+    window 秒内至少有 min_calls 次调用且失败率达到 failure_rate 时打开，open_seconds 内的调用直接失败；
+    之后进入半开状态，只放行一个探测调用，成功则关闭，失败则重新打开
+    （探测调用被取消、open_seconds 内没有结果时再放行下一个）。
+    打开之前已经发出的调用在熔断期间返回的结果不影响状态，半开状态只由探测调用的结果决定。
+    """
+
+    def __init__(self, failure_rate: float = 0.5, min_calls: int = 10, window: float = 30.0,
+                 open_seconds: float = 15.0):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self._outcomes: Deque[tuple] = deque()
+        self._open_until = 0.0
+        self._probe_started: Optional[float] = None
+        self._opened = 0
+
+    def check(self) -> bool:
+        """调用前检查，熔断中抛出 UpstreamUnavailableError
+
+        Returns:
+            bool: 本次调用是否为半开状态的探测调用，调用结束后传给 record()
+        """
+        if self.state == "closed":
+            return False
+        now = time.monotonic()
+        if self.state == "open":
+            if now < self._open_until:
+                raise UpstreamUnavailableError(self._open_until - now)
+            self.state = "half_open"
+        if self._probe_started is not None and now - self._probe_started < self.open_seconds:
+            raise UpstreamUnavailableError(self._probe_started + self.open_seconds - now)
+        self._probe_started = now
+        return True
+
+    def record(self, succeeded: bool, probe: bool = False):
+        now = time.monotonic()
+        if probe:
+            self._probe_started = None
+            if self.state == "half_open":
+                if succeeded:
+                    self.state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._open(now)
+            return
+        if self.state != "closed":
+            # 熔断前发出、熔断后才返回的调用
+            return
+
+        self._outcomes.append((now, succeeded))
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+        failures = sum(1 for _, ok in self._outcomes if not ok)
+        if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+            self._open(now)
+
+    def _open(self, now: float):
+        print(f"Circuit breaker opened for {self.open_seconds}s")
+        self.state = "open"
+        self._open_until = now + self.open_seconds
+        self._outcomes.clear()
+        self._opened += 1
+
+    def stats(self) -> Dict:
+        return {"state": self.state, "opened": self._opened}
+
+
+class LatencyTracker:
+    """最近若干次成功调用的耗时，用于计算对冲请求的等待时间"""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, p: float) -> Optional[float]:
+        if len(self._samples) < 20:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD 自适应并发上限 + 优先级队列（只在事件循环线程中使用）
+
+    - 请求成功且未拥塞时，上限每轮约加 1（每次成功加 1/limit）；
+    - 遇到拥塞信号（限流、超时、延迟超过阈值）时，上限乘以 backoff，cooldown 秒内最多降一次；
+    - 排队的请求按优先级出队，同优先级先到先得；
+    - 每个优先级最多占用上限的 PRIORITY_SHARES 比例。
+    """
+
+    def __init__(self, initial_limit: float = 8, min_limit: float = 1, max_limit: float = 64,
+                 backoff: float = 0.7, cooldown: float = 1.0):
+        self.limit = float(initial_limit)
+        self.min_limit = float(min_limit)
+        self.max_limit = float(max_limit)
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self._inflight = 0
+        self._waiters: List[tuple] = []
+        self._seq = itertools.count()
+        self._last_decrease = 0.0
+        self._decreases = 0
+        self._congestion_signals = 0
+
+    @property
+    def has_capacity(self) -> bool:
+        return not self._waiters and self._inflight < self.limit
+
+    def _can_start(self, priority: Priority) -> bool:
+        return self._inflight < max(1.0, self.limit * PRIORITY_SHARES[priority])
+
+    async def acquire(self, priority: Priority):
+        """获取一个名额，没有名额时按优先级排队等待
+
+        只有同等或更高优先级的请求在排队时才需要排在它们后面；
+        低优先级请求因份额用满而排队时，高优先级请求有空闲名额就直接开始。
+        """
+        queued_ahead = bool(self._waiters) and self._waiters[0][0] <= priority
+        if not queued_ahead and self._can_start(priority):
+            self._inflight += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        # 队首可能是已取消的请求，立即尝试分配名额，不必等到下一次 release
+        self._wake()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # 已分到名额但调用方被取消，归还名额
+                self._inflight -= 1
+                self._wake()
+            raise
+
+    def release(self, congested: bool = False, succeeded: bool = True):
+        """归还名额并根据结果调整上限
+
+        Args:
+            congested (bool): 本次调用是否遇到拥塞信号
+            succeeded (bool): 本次调用是否成功（失败但非拥塞时上限不变）
+        """
+        saturated = self._inflight >= int(self.limit) or bool(self._waiters)
+        self._inflight -= 1
+        if congested:
+            self._congestion_signals += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+                self._last_decrease = now
+                self._decreases += 1
+        elif succeeded and saturated:
+            # 只在上限确实被用满时增加，空闲时上限不会无限增长
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            priority, _, future = self._waiters[0]
+            if future.cancelled():
+                heapq.heappop(self._waiters)
+                continue
+            # 份额随优先级递减，队首无法开始时后面的也无法开始
+            if not self._can_start(priority):
+                break
+            heapq.heappop(self._waiters)
+            self._inflight += 1
+            future.set_result(None)
+
+    def stats(self) -> Dict:
+        queued: Dict[str, int] = {}
+        for priority, _, future in self._waiters:
+            if not future.cancelled():
+                name = Priority(priority).name.lower()
+                queued[name] = queued.get(name, 0) + 1
+        return {
+            "limit": round(self.limit, 2),
+            "inflight": self._inflight,
+            "queued": queued,
+            "decreases": self._decreases,
+            "congestion_signals": self._congestion_signals
+        }
+
+
+class UpstreamGateway:
+    """所有模型调用的统一出口：并发控制、优先级排队、限流后退避重试、熔断和对冲请求
+
+    SDK 自带的重试不经过并发控制，会在限流时放大请求量，应将其关闭（max_retries=0），
+    由这里重新排队后重试。
+    """
+
+    def __init__(self, client, limiter: AdaptiveConcurrencyLimiter, max_retries: int = 2,
+                 latency_threshold: float = 30.0, first_token_threshold: float = 5.0,
+                 retry_base_seconds: float = 0.5, breaker: Optional[CircuitBreaker] = None,
+                 hedge_percentile: float = 0.95, hedge_min_delay: float = 1.0):
+        """
+        Args:
+            client: AsyncArk 客户端
+            limiter (AdaptiveConcurrencyLimiter): 并发控制
+            max_retries (int): 拥塞错误的最多重试次数
+            latency_threshold (float): 非流式调用耗时超过该值（秒）视为拥塞
+            first_token_threshold (float): 流式调用首个分片超过该值（秒）视为拥塞
+            retry_base_seconds (float): 第一次重试前的等待时间，之后每次翻倍并加随机抖动
+            breaker (CircuitBreaker): 熔断器，为空时不熔断
+            hedge_percentile (float): 对冲请求在同优先级调用耗时的该分位数之后发出
+            hedge_min_delay (float): 对冲请求的最短等待时间（秒）
+        """
+        self.client = client
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.latency_threshold = latency_threshold
+        self.first_token_threshold = first_token_threshold
+        self.retry_base_seconds = retry_base_seconds
+        self.breaker = breaker
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self._latencies: Dict[Priority, LatencyTracker] = {}
+        self._calls: Dict[str, int] = {}
+        self._retries = 0
+        self._hedges = 0
+        self._hedge_wins = 0
+
+    def _count(self, priority: Priority):
+        name = priority.name.lower()
+        self._calls[name] = self._calls.get(name, 0) + 1
+
+    def _check_breaker(self) -> bool:
+        """每次尝试（包括重试）前检查熔断器，返回是否为探测调用"""
+        if self.breaker is not None:
+            return self.breaker.check()
+        return False
+
+    def _record_outcome(self, error: Optional[Exception] = None, probe: bool = False):
+        # 4xx（含限流）说明上游可以正常响应，不计为失败
+        if self.breaker is not None:
+            self.breaker.record(error is None or not is_upstream_failure(error), probe)
+
+    async def _backoff(self, attempt: int):
+        self._retries += 1
+        delay = self.retry_base_seconds * 2 ** attempt
+        await asyncio.sleep(delay + random.uniform(0, delay))
+
+    def hedge_delay(self, priority: Priority) -> Optional[float]:
+        """对冲请求的等待时间；样本不足时返回 None（不对冲）"""
+        tracker = self._latencies.get(priority)
+        latency = tracker.percentile(self.hedge_percentile) if tracker else None
+        return None if latency is None else max(latency, self.hedge_min_delay)
+
+    async def create(self, priority: Priority, hedge: bool = False, **kwargs):
+        """非流式调用
+
+        Args:
+            priority (Priority): 优先级
+            hedge (bool): 是否允许对冲：超过同优先级调用耗时的 p95 仍未返回时再发一个相同的请求，
+                采用先完成的结果。只应用于可重复执行的调用（如生成后续问题、出题）
+        """
+        self._count(priority)
+        delay = self.hedge_delay(priority) if hedge else None
+        if delay is None:
+            return await self._create_with_retries(priority, kwargs)
+
+        primary = asyncio.ensure_future(self._create_with_retries(priority, kwargs))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        # 网关已经在排队时不再发对冲请求，避免加重上游负担
+        if done or not self.limiter.has_capacity:
+            return await primary
+
+        self._hedges += 1
+        hedged = asyncio.ensure_future(self._create_with_retries(priority, kwargs))
+        pending = {primary, hedged}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedged:
+                            self._hedge_wins += 1
+                        return task.result()
+            # 两个请求都失败，抛出原请求的错误
+            return primary.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _create_with_retries(self, priority: Priority, kwargs: Dict):
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(priority)
+            congested = False
+            succeeded = False
+            start = time.monotonic()
+            try:
+                # 排队和退避期间熔断器可能已经打开
+                probe = self._check_breaker()
+                response = await self.client.chat.completions.create(**kwargs)
+                latency = time.monotonic() - start
+                succeeded = True
+                congested = latency > self.latency_threshold
+                self._latencies.setdefault(priority, LatencyTracker()).record(latency)
+                self._record_outcome(probe=probe)
+                return response
+            except UpstreamUnavailableError:
+                raise
+            except Exception as e:
+                self._record_outcome(e, probe)
+                congested = is_overload_error(e)
+                if not congested or attempt == self.max_retries:
+                    raise
+            finally:
+                self.limiter.release(congested, succeeded)
+            await self._backoff(attempt)
+
+    async def stream(self, priority: Priority, **kwargs):
+        """流式调用，逐个产出 chunk；整个流持续期间占用一个名额
+
+        只有在收到第一个分片之前失败才会重试，已经输出的内容不会重复。
+        """
+        self._count(priority)
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(priority)
+            congested = False
+            succeeded = False
+            started = False
+            start = time.monotonic()
+            try:
+                probe = self._check_breaker()
+                stream = await self.client.chat.completions.create(stream=True, **kwargs)
+                async for chunk in stream:
+                    if not started:
+                        started = True
+                        congested = time.monotonic() - start > self.first_token_threshold
+                        self._record_outcome(probe=probe)
+                    yield chunk
+                succeeded = True
+                return
+            except UpstreamUnavailableError:
+                raise
+            except Exception as e:
+                if not started:
+                    self._record_outcome(e, probe)
+                congested = is_overload_error(e)
+                if started or not congested or attempt == self.max_retries:
+                    raise
+            finally:
+                self.limiter.release(congested, succeeded)
+            await self._backoff(attempt)
+
+    def stats(self) -> Dict:
+        return {
+            **self.limiter.stats(),
+            "calls": dict(self._calls),
+            "retries": self._retries,
+            "hedges": self._hedges,
+            "hedge_wins": self._hedge_wins,
+            "hedge_delay_seconds": {
+                priority.name.lower(): self.hedge_delay(priority) for priority in self._latencies
+            },
+            "circuit_breaker": self.breaker.stats() if self.breaker else None
+        }
@@ -0,0 +1,295 @@
+import os
+import time
+import threading
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import chromadb
+
+
+def close_client(client):
+    """释放 PersistentClient 占用的 SQLite/索引文件句柄"""
+    try:
+        system = client._system
+        system.stop()
+        # chromadb 按路径缓存 System 实例，需要一并移除，否则句柄不会释放
+        cache = chromadb.api.client.SharedSystemClient._identifier_to_system
+        for identifier, cached in list(cache.items()):
+            if cached is system:
+                del cache[identifier]
+    except Exception as e:
+        print(f"Error closing chroma client: {e}")
+
+
+class PoolEntry:
+    """连接池中一个会话的客户端；refs 为正在使用的请求数，大于 0 时不会被关闭"""
+
+    def __init__(self):
+        self.client = None
+        self.collection = None
+        self.last_used = time.monotonic()
+        self.refs = 0
+        self.close_on_release = False
+        self.error = None
+        self.ready = threading.Event()
+
+
+class SessionCollectionPool:
+    """进程内共享的会话向量库连接池
+
+    每个会话对应 ./chroma_dbs/{session_id}.db 下的一个 PersistentClient。
+    打开的客户端按最近使用顺序缓存，超过 max_open 或空闲超过 idle_seconds 时关闭，
+    避免每轮对话都重新打开 SQLite 文件和 HNSW 索引，也避免文件句柄无限增长。
+
+    通过 lease() 使用 collection：租用期间客户端不会被淘汰或关闭（被租用的客户端可以暂时超出 max_open），
+    会话结束时调用 evict() 也会等到最后一个租用释放后才关闭。
+    打开客户端（数十毫秒）不持有全局锁，只有等待同一会话的请求需要等待。
+    """
+
+    def __init__(self, root: str = "./chroma_dbs", max_open: int = 128, idle_seconds: float = 600):
+        self.root = root
+        self.max_open = max_open
+        self.idle_seconds = idle_seconds
+        self._entries: "OrderedDict[str, PoolEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def lease(self, session_id: str, user_id: str = None):
+        """租用会话的 collection，不存在时打开（或创建）"""
+        entry = self._acquire(session_id)
+        try:
+            yield entry.collection
+        finally:
+            self._release(session_id, entry)
+
+    def _acquire(self, session_id: str) -> PoolEntry:
+        with self._lock:
+            entry = self._entries.get(session_id)
+            opening = entry is None
+            if opening:
+                entry = PoolEntry()
+                self._entries[session_id] = entry
+            else:
+                self._entries.move_to_end(session_id)
+            entry.refs += 1
+            entry.close_on_release = False
+
+        if not opening:
+            entry.ready.wait()
+            if entry.error is not None:
+                with self._lock:
+                    entry.refs -= 1
+                raise entry.error
+            return entry
+
+        try:
+            entry.client, entry.collection = self._open(session_id)
+        except Exception as e:
+            entry.error = e
+            with self._lock:
+                entry.refs -= 1
+                if self._entries.get(session_id) is entry:
+                    del self._entries[session_id]
+            raise
+        finally:
+            entry.ready.set()
+
+        with self._lock:
+            stale = self._evict_locked(time.monotonic())
+        for client in stale:
+            self._close(client)
+        return entry
+
+    def _release(self, session_id: str, entry: PoolEntry):
+        with self._lock:
+            entry.refs -= 1
+            entry.last_used = time.monotonic()
+            if entry.refs == 0 and entry.close_on_release:
+                if self._entries.get(session_id) is entry:
+                    del self._entries[session_id]
+                stale = [entry.client]
+            else:
+                # 租用期间超出 max_open 的部分在释放后关闭
+                stale = self._evict_locked(entry.last_used)
+        for client in stale:
+            self._close(client)
+
+    def evict(self, session_id: str):
+        """关闭并移除会话的客户端（会话结束时调用）；仍在使用时在最后一个租用释放后关闭"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                return
+            if entry.refs:
+                entry.close_on_release = True
+                return
+            del self._entries[session_id]
+        self._close(entry.client)
+
+    def evict_idle(self):
+        """关闭所有空闲超时的客户端"""
+        with self._lock:
+            stale = self._evict_locked(time.monotonic())
+        for client in stale:
+            self._close(client)
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            if entry.client is not None:
+                self._close(entry.client)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "open": len(self._entries),
+                "leased": sum(1 for entry in self._entries.values() if entry.refs),
+                "max_open": self.max_open
+            }
+
+    def _open(self, session_id: str) -> tuple:
+        os.makedirs(self.root, exist_ok=True)
+        client = chromadb.PersistentClient(path=os.path.join(self.root, f"{session_id}.db"))
+        collection = client.get_or_create_collection(
+            name="chat_history",
+            metadata={"session_id": session_id}
+        )
+        return client, collection
+
+    def _evict_locked(self, now: float) -> list:
+        """从字典中移除超出上限或空闲超时的未租用客户端，返回需要在锁外关闭的客户端"""
+        stale = []
+        # 按最近使用顺序排列，队首最久未用；租用中的跳过
+        for session_id, entry in list(self._entries.items()):
+            if entry.refs:
+                continue
+            if len(self._entries) <= self.max_open and now - entry.last_used < self.idle_seconds:
+                break
+            del self._entries[session_id]
+            stale.append(entry.client)
+        return stale
+
+    @staticmethod
+    def _close(client):
+        close_client(client)
+
+
+class SessionCollection:
+    """共享 collection 中某个会话的视图
+
+    接口与 chromadb Collection 的 get/add/upsert/count 保持一致，
+    读操作自动按 session_id 过滤，写操作自动补充 session_id/user_id 元数据并给 id 加会话前缀。
+    """
+
+    def __init__(self, collection, session_id: str, user_id: str = None):
+        self.collection = collection
+        self.session_id = session_id
+        self.user_id = user_id
+
+    def _scoped_where(self, where: dict = None) -> dict:
+        scope = {"session_id": self.session_id}
+        if not where:
+            return scope
+        return {"$and": [scope, where]}
+
+    def _scoped_id(self, item_id: str) -> str:
+        return f"{self.session_id}:{item_id}"
+
+    def get(self, ids=None, where: dict = None, **kwargs):
+        if ids is not None:
+            ids = [self._scoped_id(i) for i in ids]
+        return self.collection.get(ids=ids, where=self._scoped_where(where), **kwargs)
+
+    def query(self, where: dict = None, **kwargs):
+        return self.collection.query(where=self._scoped_where(where), **kwargs)
+
+    def _scoped_metadatas(self, ids, metadatas) -> list:
+        metadatas = [dict(m or {}) for m in (metadatas or [{}] * len(ids))]
+        for metadata in metadatas:
+            metadata["session_id"] = self.session_id
+            if self.user_id:
+                metadata["user_id"] = self.user_id
+        return metadatas
+
+    def add(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.collection.add(
+            ids=[self._scoped_id(i) for i in ids],
+            documents=documents,
+            metadatas=self._scoped_metadatas(ids, metadatas),
+            embeddings=embeddings
+        )
+
+    def upsert(self, ids, documents=None, metadatas=None, embeddings=None):
+        self.collection.upsert(
+            ids=[self._scoped_id(i) for i in ids],
+            documents=documents,
+            metadatas=self._scoped_metadatas(ids, metadatas),
+            embeddings=embeddings
+        )
+
+    def count(self) -> int:
+        return len(self.collection.get(where=self._scoped_where(), include=[])["ids"])
+
+
+class SharedVectorStore:
+    """所有会话共用的向量库
+
+    所有问答轮次写入同一个目录下的 shards 个 collection（按 session_id 哈希分片），
+    以 session_id/user_id 元数据区分，查询时按元数据过滤。
+    与 SessionCollectionPool 提供相同的 lease/evict/evict_idle/close_all 接口。
+    """
+
+    def __init__(self, path: str = "./chroma_shared", shards: int = 1):
+        self.path = path
+        self.shards = max(1, shards)
+        os.makedirs(path, exist_ok=True)
+        self.client = chromadb.PersistentClient(path=path)
+        self.collections = [
+            self.client.get_or_create_collection(name=f"chat_history_{i}")
+            for i in range(self.shards)
+        ]
+
+    def collection_for(self, session_id: str):
+        return self.collections[zlib.crc32(session_id.encode("utf-8")) % self.shards]
+
+    @contextmanager
+    def lease(self, session_id: str, user_id: str = None):
+        # 共享客户端只在 close_all 时关闭，不需要按会话计数
+        yield SessionCollection(self.collection_for(session_id), session_id, user_id)
+
+    def evict(self, session_id: str):
+        # 共享模式下没有按会话打开的句柄
+        pass
+
+    def evict_idle(self):
+        pass
+
+    def close_all(self):
+        close_client(self.client)
+
+    def stats(self) -> dict:
+        return {"shards": self.shards, "documents": sum(c.count() for c in self.collections)}
+
+
+def create_session_store():
+    """根据环境变量 VECTOR_STORE_MODE 创建会话向量库
+
+    per_session（默认）：每个会话一个目录，使用连接池；
+    shared：所有会话共用 CHROMA_SHARED_PATH 下的 CHROMA_SHARDS 个 collection。
+    """
+    mode = os.environ.get("VECTOR_STORE_MODE", "per_session")
+    if mode == "shared":
+        return SharedVectorStore(
+            path=os.environ.get("CHROMA_SHARED_PATH", "./chroma_shared"),
+            shards=int(os.environ.get("CHROMA_SHARDS", 1))
+        )
+    if mode != "per_session":
+        raise ValueError(f"Unknown VECTOR_STORE_MODE: {mode}")
+    return SessionCollectionPool(
+        root="./chroma_dbs",
+        max_open=int(os.environ.get("CHROMA_POOL_SIZE", 128)),
+        idle_seconds=float(os.environ.get("CHROMA_POOL_IDLE_SECONDS", 600))
+    )